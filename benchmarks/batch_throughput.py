@@ -0,0 +1,63 @@
+"""
+Compare the throughput of extract_pv_slices with a loop over
+extract_pv_slice, for many paths extracted from the same SpectralCube.
+
+Usage::
+
+    python benchmarks/batch_throughput.py [n_paths]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from pvextractor import Path, extract_pv_slice, extract_pv_slices
+
+
+def make_cube(nz=200, ny=512, nx=512):
+    from spectral_cube import SpectralCube
+    wcs = WCS(naxis=3)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN', 'VRAD']
+    wcs.wcs.cunit = ['deg', 'deg', 'km/s']
+    wcs.wcs.cdelt = [-1. / 3600, 1. / 3600, 0.5]
+    wcs.wcs.crpix = [nx / 2, ny / 2, 1]
+    wcs.wcs.crval = [83.8, -5.4, -50.]
+    data = np.random.random((nz, ny, nx)).astype(np.float32)
+    data[:, ::37, ::41] = np.nan
+    hdu = fits.PrimaryHDU(data=data, header=wcs.to_header())
+    hdu.header['BUNIT'] = 'K'
+    return SpectralCube.read(hdu)
+
+
+def main(n_paths=100):
+
+    cube = make_cube()
+
+    np.random.seed(12345)
+    paths = []
+    for i in range(n_paths):
+        x0, y0 = np.random.uniform(50, 450, 2)
+        x1, y1 = np.random.uniform(50, 450, 2)
+        width = None if i % 2 == 0 else 5.
+        paths.append(Path([(x0, y0), (x1, y1)], width=width))
+
+    time1 = time.time()
+    for path in paths:
+        extract_pv_slice(cube, path)
+    loop = time.time() - time1
+
+    time1 = time.time()
+    extract_pv_slices(cube, paths)
+    batch = time.time() - time1
+
+    print("{0} paths".format(n_paths))
+    print("extract_pv_slice loop: {0:8.2f} s ({1:8.1f} paths/s)".format(loop, n_paths / loop))
+    print("extract_pv_slices:     {0:8.2f} s ({1:8.1f} paths/s)".format(batch, n_paths / batch))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
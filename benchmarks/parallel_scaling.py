@@ -0,0 +1,66 @@
+"""
+Measure how the run time of extract_slice scales with the number of threads
+(or processes) used.
+
+Usage::
+
+    python benchmarks/parallel_scaling.py [max_jobs] [executor]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+from pvextractor.geometry import Path, extract_slice
+
+
+def best_time(function, repeat=3):
+    times = []
+    for i in range(repeat):
+        time1 = time.time()
+        result = function()
+        times.append(time.time() - time1)
+    return min(times), result
+
+
+def main(max_jobs=None, executor='thread'):
+
+    if max_jobs is None:
+        max_jobs = os.cpu_count() or 1
+
+    cube = np.random.random((400, 512, 512)).astype(np.float32)
+
+    cases = [('line, order=3', Path([(50., 50.), (450., 300.)]), dict(order=3)),
+             ('width=30', Path([(50., 50.), (450., 300.)], width=30.), {})]
+
+    n_jobs_values = sorted(set([1, 2, 4, 8, 16, 32, max_jobs]))
+    n_jobs_values = [n for n in n_jobs_values if n <= max_jobs]
+
+    for label, path, kwargs in cases:
+
+        print("{0} ({1} executor)".format(label, executor))
+        print("{0:>8s} {1:>10s} {2:>8s} {3:>10s}".format("n_jobs", "Time (s)", "Speedup",
+                                                         "Identical"))
+
+        # The first call computes the path geometry, which is then cached
+        reference = extract_slice(cube, path, **kwargs)
+        serial, _ = best_time(lambda: extract_slice(cube, path, **kwargs))
+
+        for n_jobs in n_jobs_values:
+            elapsed, result = best_time(lambda: extract_slice(cube, path, n_jobs=n_jobs,
+                                                              executor=executor,
+                                                              **kwargs))
+            identical = np.array_equal(result, reference, equal_nan=True)
+            print("{0:>8d} {1:>10.3f} {2:>8.2f} {3:>10s}".format(n_jobs, elapsed,
+                                                                 serial / elapsed,
+                                                                 str(identical)))
+
+        print("")
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(int(args[0]) if len(args) > 0 else None,
+         args[1] if len(args) > 1 else 'thread')
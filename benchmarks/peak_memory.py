@@ -0,0 +1,55 @@
+"""
+Measure the run time and peak memory used by extract_slice for a path that
+covers a small fraction of a large cube containing NaN values.
+
+Usage::
+
+    python benchmarks/peak_memory.py [nz] [ny] [nx]
+"""
+
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from pvextractor.geometry import Path, extract_slice
+
+
+def measure(cube, path, **kwargs):
+    tracemalloc.start()
+    time1 = time.time()
+    extract_slice(cube, path, **kwargs)
+    time2 = time.time()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return time2 - time1, peak
+
+
+def main(nz=200, ny=1024, nx=1024):
+
+    cube = np.random.random((nz, ny, nx)).astype(np.float32)
+    cube[::10, ::50, ::50] = np.nan
+
+    print("Cube size: {0:.1f} MB".format(cube.nbytes / 1024 ** 2))
+    print("{0:<40s} {1:>10s} {2:>16s}".format("Case", "Time (s)", "Peak memory (MB)"))
+
+    line = Path([(100., 100.), (400., 150.)])
+    wide = Path([(100., 100.), (400., 150.)], width=20.)
+
+    cases = [('line, order=0', line, dict(order=0)),
+             ('line, order=1', line, dict(order=1)),
+             ('line, order=3', line, dict(order=3)),
+             ('line, order=3, respect_nan=False', line, dict(order=3, respect_nan=False)),
+             ('width=20', wide, {}),
+             ('width=20, respect_nan=False', wide, dict(respect_nan=False))]
+
+    for label, path, kwargs in cases:
+        # The first call computes the path geometry, which is then cached
+        extract_slice(cube, path, **kwargs)
+        elapsed, peak = measure(cube, path, **kwargs)
+        print("{0:<40s} {1:>10.3f} {2:>16.1f}".format(label, elapsed, peak / 1024 ** 2))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,64 @@
+"""
+Compare the time taken to extract slices along wide paths from a cube in the
+usual (nz, ny, nx) layout and from a TransposedCube, in which the spectrum of
+each pixel is contiguous in memory, for several cube sizes.
+
+Usage::
+
+    python benchmarks/spectral_layout.py [n_paths]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from pvextractor import Path, ExtractionPlan, TransposedCube
+
+SIZES = [(100, 256, 256), (400, 256, 256), (200, 512, 512), (800, 512, 512)]
+
+
+def make_plans(n_paths, ny, nx):
+    # The geometry of the paths is computed once here, so that only the
+    # extraction itself is timed below.
+    np.random.seed(12345)
+    plans = []
+    for i in range(n_paths):
+        x0, x1 = np.random.uniform(0.1 * nx, 0.9 * nx, 2)
+        y0, y1 = np.random.uniform(0.1 * ny, 0.9 * ny, 2)
+        plans.append(ExtractionPlan(Path([(x0, y0), (x1, y1)], width=8.), 1., (ny, nx)))
+    return plans
+
+
+def time_extraction(cube, plans):
+    time1 = time.time()
+    for plan in plans:
+        plan.extract(cube)
+    return time.time() - time1
+
+
+def main(n_paths=20):
+
+    print("{0:>16s} {1:>10s} {2:>10s} {3:>12s} {4:>8s}".format('shape', 'usual [s]',
+                                                             'copy [s]', 'transposed [s]',
+                                                             'speedup'))
+
+    for shape in SIZES:
+
+        cube = np.random.random(shape).astype(np.float32)
+        plans = make_plans(n_paths, *shape[1:])
+
+        usual = time_extraction(cube, plans)
+
+        time1 = time.time()
+        transposed = TransposedCube(cube)
+        copy = time.time() - time1
+
+        fast = time_extraction(transposed, plans)
+
+        print("{0:>16s} {1:10.3f} {2:10.3f} {3:14.3f} {4:8.1f}".format(
+            'x'.join(str(n) for n in shape), usual, copy, fast, usual / fast))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
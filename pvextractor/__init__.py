@@ -1,7 +1,9 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 
 from . import utils
-from .pvextractor import extract_pv_slice
+from .pvextractor import extract_pv_slice, extract_pv_slices, iter_pv_slice, IncrementalExtractor
+from .survey import extract_survey
 from .utils.wcs_slicing import slice_wcs
-from .geometry import Path, PathFromCenter
+from .utils.readers import TransposedCube
+from .geometry import Path, PathFromCenter, ExtractionPlan
 from .pvregions import paths_from_regfile
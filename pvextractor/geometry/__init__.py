@@ -1,3 +1,5 @@
 from .slices import extract_slice
 from .path import Path
 from .helpers import PathFromCenter
+from .plan import ExtractionPlan, plan_cache
+from .line_slices import SplineCoefficients
@@ -8,7 +8,7 @@ from astropy.wcs import WCSSUB_CELESTIAL
 from astropy.wcs.utils import wcs_to_celestial_frame
 from astropy.coordinates import BaseCoordinateFrame
 
-from ..utils.wcs_utils import get_spatial_scale
+from ..utils.wcs_utils import get_spatial_scale, wcs_fingerprint
 
 
 class Polygon(object):
@@ -90,6 +90,13 @@ class Path(object):
         should be passed as a :class:`~astropy.units.Quantity` instance with
         units of angle. If None, interpolation is used at the position of the
         path.
+
+    Notes
+    -----
+    The pixel-space geometry of the path (the positions of the points, the
+    distance along the path and the direction of each segment) is computed
+    once for each WCS and reused for all the samplings of the path, so the
+    points should only be changed with `add_point`.
     """
 
     def __init__(self, xy_or_coords, width=None):
@@ -102,8 +109,23 @@ class Path(object):
         else:
             self._xy = None
             self._coords = xy_or_coords
+        # Pixel-space geometry and widths, keyed by the fingerprint of the WCS
+        self._geometry = {}
+        self._pixel_widths = {}
         self.width = width
 
+    @property
+    def width(self):
+        """
+        The width of the path (see `Path`).
+        """
+        return self._width
+
+    @width.setter
+    def width(self, value):
+        self._width = value
+        self._pixel_widths.clear()
+
     def add_point(self, xy_or_coord):
         """
         Add a point to the path
@@ -118,6 +140,7 @@ class Path(object):
         if self._xy is not None:
             if isinstance(xy_or_coord, tuple):
                 self._xy.append(xy_or_coord)
+                self._geometry.clear()
             else:
                 raise TypeError("Path is defined as a list of pixel "
                                 "coordinates, so `xy_or_coord` should be "
@@ -146,34 +169,92 @@ class Path(object):
         if self._xy is not None:
             return self._xy
         else:
-            if wcs is None:
-                raise ValueError("`wcs` is needed in order to compute "
-                                 "the pixel coordinates")
+            x, y = self._pixel_geometry(wcs)[:2]
+            return list(zip(x, y))
+
+    def _world2pix(self, wcs):
+        """
+        Transform the points of a path defined in world coordinates to pixel
+        coordinates.
+        """
+
+        if wcs is None:
+            raise ValueError("`wcs` is needed in order to compute "
+                             "the pixel coordinates")
+
+        # Extract the celestial component of the WCS
+        wcs_sky = wcs.sub([WCSSUB_CELESTIAL])
+
+        # Find the astropy name for the coordinates
+        celestial_system = wcs_to_celestial_frame(wcs_sky)
+
+        world_coords = self._coords.transform_to(celestial_system)
+
+        xw, yw = world_coords.spherical.lon.degree, world_coords.spherical.lat.degree
+
+        return wcs_sky.wcs_world2pix(xw, yw, 0)
+
+    def _pixel_geometry(self, wcs=None, key=None):
+        """
+        Return the pixel coordinates ``x`` and ``y`` of the points, the
+        distance ``d`` along the path at each point, and the unit vector
+        ``(ux, uy)`` along each segment. These are computed once for each
+        WCS (identified by ``key``, the fingerprint of the WCS, if already
+        known).
+        """
+
+        if self._xy is not None:
+            key = None
+        elif key is None:
+            key = wcs_fingerprint(wcs)
+
+        if key not in self._geometry:
+
+            if self._xy is not None:
+                x, y = (np.array(values, dtype=float) for values in zip(*self._xy))
             else:
+                x, y = self._world2pix(wcs)
 
-                # Extract the celestial component of the WCS
-                wcs_sky = wcs.sub([WCSSUB_CELESTIAL])
+            # Find the distance interval between all pairs of points
+            dx = np.diff(x)
+            dy = np.diff(y)
+            dd = np.hypot(dx, dy)
 
-                # Find the astropy name for the coordinates
-                celestial_system = wcs_to_celestial_frame(wcs_sky)
+            # Find the total displacement along the broken curve
+            d = np.hstack([0., np.cumsum(dd)])
 
-                world_coords = self._coords.transform_to(celestial_system)
+            # Normalize to find unit vectors (repeated points give NaN)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ux = dx / dd
+                uy = dy / dd
 
-                xw, yw = world_coords.spherical.lon.degree, world_coords.spherical.lat.degree
+            self._geometry[key] = x, y, d, ux, uy
 
-                return list(zip(*wcs_sky.wcs_world2pix(xw, yw, 0)))
+        return self._geometry[key]
 
-    def sample_points_edges(self, spacing, wcs=None):
+    def _pixel_width(self, wcs=None, key=None):
+        """
+        Return the width of the path in pixels.
+        """
+
+        if not hasattr(self.width, 'unit'):
+            return self.width
+
+        if key is None:
+            key = wcs_fingerprint(wcs)
 
-        x, y = zip(*self.get_xy(wcs=wcs))
+        if key not in self._pixel_widths:
+            scale = get_spatial_scale(wcs)
+            self._pixel_widths[key] = (self.width / scale).decompose().value
+
+        return self._pixel_widths[key]
 
-        # Find the distance interval between all pairs of points
-        dx = np.diff(x)
-        dy = np.diff(y)
-        dd = np.hypot(dx, dy)
+    def sample_points_edges(self, spacing, wcs=None):
+        return self._sample_edges(spacing, self._pixel_geometry(wcs))
 
-        # Find the total displacement along the broken curve
-        d = np.hstack([0., np.cumsum(dd)])
+    def _sample_edges(self, spacing, geometry):
+
+        x, y, d = geometry[:3]
 
         # Figure out the number of points to sample, and stop short of the
         # last point.
@@ -182,7 +263,9 @@ class Path(object):
         if n_points == 0:
             raise ValueError("Path is shorter than spacing")
 
-        d_sampled = np.linspace(0., n_points * spacing, n_points + 1)
+        # Each sample only depends on its index (rather than on the number of
+        # samples), so that extending a path does not move existing samples.
+        d_sampled = np.arange(n_points + 1) * spacing
 
         x_sampled = np.interp(d_sampled, d, x)
         y_sampled = np.interp(d_sampled, d, y)
@@ -200,21 +283,17 @@ class Path(object):
 
     def sample_polygons(self, spacing, wcs=None):
 
-        x, y = zip(*self.get_xy(wcs=wcs))
-
-        d_sampled, x_sampled, y_sampled = self.sample_points_edges(spacing, wcs=wcs)
+        # Only compute the fingerprint of the WCS once, and only if needed
+        if self._xy is None or hasattr(self.width, 'unit'):
+            key = wcs_fingerprint(wcs)
+        else:
+            key = None
 
-        # Find the distance interval between all pairs of points
-        dx = np.diff(x)
-        dy = np.diff(y)
-        dd = np.hypot(dx, dy)
+        geometry = self._pixel_geometry(wcs, key=key)
 
-        # Normalize to find unit vectors
-        dx = dx / dd
-        dy = dy / dd
+        d_sampled, x_sampled, y_sampled = self._sample_edges(spacing, geometry)
 
-        # Find the total displacement along the broken curve
-        d = np.hstack([0., np.cumsum(dd)])
+        d, dx, dy = geometry[2:]
 
         interval = np.searchsorted(d, d_sampled) - 1
         interval[0] = 0
@@ -230,11 +309,7 @@ class Path(object):
         y_beg = y_sampled
         y_end = y_sampled + dy * spacing
 
-        if hasattr(self.width, 'unit'):
-            scale = get_spatial_scale(wcs)
-            width = (self.width / scale).decompose().value
-        else:
-            width = self.width
+        width = self._pixel_width(wcs, key=key)
 
         x1 = x_beg - dy * width * 0.5
         y1 = y_beg + dx * width * 0.5
@@ -0,0 +1,1002 @@
+import os
+import pickle
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import (Executor, ThreadPoolExecutor,
+                                ProcessPoolExecutor)
+
+import numpy as np
+from astropy import units as u
+
+from ..utils.wcs_utils import wcs_fingerprint, get_spectral_channels
+from ..utils.readers import chunk_shape, TransposedCube
+from .line_slices import (extract_line_slice, line_footprint, output_dtype, KERNELS,
+                          line_weights, apply_line_weights, _linear_support,
+                          _kernel_support, _check_order)
+from .poly_slices import polygon_weights, apply_polygon_weights, weights_footprint
+
+
+def path_fingerprint(path):
+    """
+    Return a string that uniquely identifies the definition of a path.
+    """
+
+    sha = hashlib.sha1()
+
+    if path._xy is not None:
+        sha.update(b'pixel')
+        sha.update(np.asarray(path._xy, dtype=float).tobytes())
+    else:
+        frame = getattr(path._coords, 'frame', path._coords)
+        sha.update(frame.name.encode('utf-8'))
+        for name in sorted(frame.frame_attributes):
+            sha.update(repr(getattr(frame, name)).encode('utf-8'))
+        sha.update(np.asarray(frame.spherical.lon.degree, dtype=float).tobytes())
+        sha.update(np.asarray(frame.spherical.lat.degree, dtype=float).tobytes())
+
+    sha.update(repr(path.width).encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def plan_fingerprint(path, spacing, shape, wcs=None, engine='vectorized',
+                     template_resolution=None):
+    """
+    Return a string that uniquely identifies the geometry of an extraction.
+    """
+    key = [path_fingerprint(path), repr(float(spacing)),
+           repr(tuple(int(n) for n in shape[-2:])), wcs_fingerprint(wcs)]
+    if path.width is not None:
+        key.append(engine)
+        if template_resolution is not None:
+            key.append(repr(float(template_resolution)))
+    return hashlib.sha1(':'.join(key).encode('utf-8')).hexdigest()
+
+
+class ExtractionPlan(object):
+    """
+    The pixel-space geometry needed to extract a slice along a path from
+    cubes with a given WCS and spatial shape.
+
+    For paths with zero width, this contains the positions of the samples
+    along the path. For paths with a non-zero width, this contains the
+    overlap between each polygon and each pixel as a sparse matrix. Plans can
+    be reused for any cube defined on the same grid, and can be written to
+    and read from disk.
+
+    Parameters
+    ----------
+    path : `Path`
+        The path along which to define the slice
+    spacing : float
+        The position resolution in the final slice, in pixels
+    shape : tuple
+        The shape of the cubes to extract slices from. Only the last two
+        (spatial) dimensions are used.
+    wcs : :class:`~astropy.wcs.WCS`, optional
+        The WCS transformation needed if the path is defined in world
+        coordinates.
+    engine : {'vectorized', 'matplotlib'}, optional
+        The engine used to compute the overlap between polygons and pixels,
+        for paths with a non-zero width.
+    template_resolution : float, optional
+        The resolution used to reuse the overlaps of translated polygons
+        along straight parts of paths with a non-zero width (see
+        `~pvextractor.geometry.poly_slices.polygon_pixel_overlaps`).
+    """
+
+    def __init__(self, path, spacing, shape, wcs=None, engine='vectorized',
+                 template_resolution=None):
+
+        fingerprint = plan_fingerprint(path, spacing, shape, wcs=wcs, engine=engine,
+                                       template_resolution=template_resolution)
+
+        if path.width is None:
+            x, y = path.sample_points(spacing=spacing, wcs=wcs)
+            self._set_geometry(shape, spacing, fingerprint, x=x, y=y)
+        else:
+            polygons = path.sample_polygons(spacing=spacing, wcs=wcs)
+            self._set_geometry(shape, spacing, fingerprint, polygons=polygons,
+                               engine=engine, template_resolution=template_resolution)
+
+    @classmethod
+    def from_samples(cls, shape, spacing, x=None, y=None, polygons=None,
+                     engine='vectorized', template_resolution=None):
+        """
+        Build a plan directly from the pixel positions ``x`` and ``y`` of the
+        samples of a path with zero width, or from the ``polygons`` of a path
+        with a non-zero width, for example for only part of a path.
+
+        The other parameters are the same as for `ExtractionPlan`.
+        """
+
+        sha = hashlib.sha1()
+        sha.update(b'samples')
+        sha.update(repr((tuple(int(n) for n in shape[-2:]), float(spacing))).encode('utf-8'))
+        if polygons is None:
+            sha.update(np.asarray(x, dtype=float).tobytes())
+            sha.update(np.asarray(y, dtype=float).tobytes())
+        else:
+            sha.update(np.asarray([p.x for p in polygons], dtype=float).tobytes())
+            sha.update(np.asarray([p.y for p in polygons], dtype=float).tobytes())
+            sha.update(repr((engine, template_resolution)).encode('utf-8'))
+
+        plan = cls.__new__(cls)
+        plan._set_geometry(shape, spacing, sha.hexdigest(), x=x, y=y, polygons=polygons,
+                           engine=engine, template_resolution=template_resolution)
+        return plan
+
+    def _set_geometry(self, shape, spacing, fingerprint, x=None, y=None, polygons=None,
+                      engine='vectorized', template_resolution=None):
+
+        self.shape = tuple(int(n) for n in shape[-2:])
+        self.spacing = spacing
+        self.fingerprint = fingerprint
+
+        if polygons is None:
+            self.x = np.asarray(x, dtype=float)
+            self.y = np.asarray(y, dtype=float)
+            self.weights = None
+        else:
+            self.x = self.y = None
+            self.weights = polygon_weights(polygons, self.shape, engine=engine,
+                                           template_resolution=template_resolution)
+
+        # Sparse interpolation weights for line paths, for each order
+        self._line_weights = {}
+
+    @property
+    def is_line(self):
+        """
+        Whether the plan is for a path with zero width.
+        """
+        return self.weights is None
+
+    @property
+    def n_samples(self):
+        """
+        The number of positions along the slice.
+        """
+        if self.is_line:
+            return len(self.x)
+        else:
+            return self.weights.shape[0]
+
+    def footprint(self, order=3):
+        """
+        The range of pixels needed to extract the slice.
+
+        For paths with zero width, this includes the margin needed so that
+        spline interpolation of order ``order`` (or interpolation with a
+        local kernel) in the footprint gives the same result as in the full
+        image.
+
+        Returns
+        -------
+        ymin, ymax, xmin, xmax : int
+            The bounds of the footprint
+        """
+        if self.is_line:
+            return line_footprint(self.x, self.y, self.shape, order=order)
+        else:
+            return weights_footprint(self.weights, self.shape)
+
+    def support(self, order=3):
+        """
+        The pixels that are actually used to extract the slice.
+
+        Returns
+        -------
+        ypix, xpix : `~numpy.ndarray` or `None`
+            The coordinates of the pixels, or `None` if all the pixels in the
+            footprint are needed (for spline interpolation with ``order > 1``).
+        """
+        if not self.is_line:
+            return np.unravel_index(np.unique(self.weights.indices), self.shape)
+        elif order == 0:
+            x = np.round(self.x).astype(int)
+            y = np.round(self.y).astype(int)
+            ok = (x >= 0) & (y >= 0) & (x < self.shape[1]) & (y < self.shape[0])
+            return y[ok], x[ok]
+        elif order == 1:
+            return _linear_support(self.x, self.y, self.shape)
+        elif order in KERNELS:
+            ys, xs = _kernel_support(self.x, self.y, self.shape)
+            return ys.ravel(), xs.ravel()
+        else:
+            return None
+
+    def line_weights(self, order=1):
+        """
+        The interpolation at the samples of a line path compiled into a
+        sparse (n_samples, ny * nx) matrix, which is computed once for each
+        ``order`` and reused for all cubes on the same grid (see
+        `~pvextractor.geometry.line_slices.line_weights`).
+        """
+        if not self.is_line:
+            raise TypeError("Interpolation weights are only defined for line paths")
+        if order not in self._line_weights:
+            self._line_weights[order] = line_weights(self.x, self.y, self.shape, order=order)
+        return self._line_weights[order]
+
+    def chunk_tiles(self, chunks, order=3):
+        """
+        The spatial tiles of a chunked cube that contain pixels used to
+        extract the slice.
+
+        Parameters
+        ----------
+        chunks : tuple
+            The shape of the chunks of the cube. Only the last two (spatial)
+            dimensions are used.
+        order : int, optional
+            Spline interpolation order when using line paths.
+
+        Returns
+        -------
+        tiles : list of tuple or `None`
+            The ``(ymin, ymax, xmin, xmax)`` bounds of each tile, clipped to
+            the footprint, or `None` if all the tiles overlapping with the
+            footprint are needed.
+        """
+
+        ymin, ymax, xmin, xmax = self.footprint(order=order)
+        if ymax <= ymin or xmax <= xmin:
+            return None
+
+        support = self.support(order=order)
+        if support is None:
+            return None
+
+        cy, cx = chunks[-2:]
+        ty0, tx0 = ymin // cy, xmin // cx
+        used = np.zeros(((ymax - 1) // cy - ty0 + 1, (xmax - 1) // cx - tx0 + 1), dtype=bool)
+        used[support[0] // cy - ty0, support[1] // cx - tx0] = True
+        if np.all(used):
+            return None
+
+        return [(max((ty0 + iy) * cy, ymin), min((ty0 + iy + 1) * cy, ymax),
+                 max((tx0 + ix) * cx, xmin), min((tx0 + ix + 1) * cx, xmax))
+                for iy, ix in zip(*np.nonzero(used))]
+
+    def bytes_per_channel(self, order=3):
+        """
+        An estimate of the memory needed to extract one channel of the slice,
+        in bytes.
+        """
+        ymin, ymax, xmin, xmax = self.footprint(order=order)
+        nbytes = (ymax - ymin) * (xmax - xmin) * 8 + self.n_samples * 8
+        if not self.is_line:
+            # Gathered values, finite mask and weighted values
+            nbytes += len(np.unique(self.weights.indices)) * 17 + self.n_samples * 8
+        return nbytes
+
+    def channels_per_block(self, nz, order=3, max_memory=None, chunk_channels=None):
+        """
+        The number of channels to process at a time.
+
+        Parameters
+        ----------
+        nz : int
+            The number of channels in the cube
+        order : int, optional
+            Spline interpolation order when using line paths.
+        max_memory : int or :class:`~astropy.units.Quantity`, optional
+            The approximate maximum amount of memory to use for each block of
+            channels, in bytes or as a quantity with units of information.
+        chunk_channels : int, optional
+            The number of channels to process at a time. This takes precedence
+            over ``max_memory``.
+        """
+        if chunk_channels is not None:
+            return max(int(chunk_channels), 1)
+        elif max_memory is not None:
+            if hasattr(max_memory, 'unit'):
+                max_memory = max_memory.to_value(u.byte)
+            return max(int(max_memory // self.bytes_per_channel(order=order)), 1)
+        else:
+            return max(nz, 1)
+
+    def extract(self, cube, order=3, respect_nan=True, coefficients=None,
+                max_memory=None, chunk_channels=None, n_jobs=1, executor=None,
+                dtype=None, spectral_range=None, spectral_bin=1, sparse=False):
+        """
+        Extract a slice from a cube with shape (z, y, x).
+
+        Only the footprint of the path in the cube is used, so that the
+        computational cost and memory usage do not depend on the size of the
+        image.
+
+        Parameters
+        ----------
+        cube : `~numpy.ndarray`
+            The data cube to extract the slice from. This can also be an
+            array-like object with a ``shape`` and supporting slicing (for
+            example a memory-mapped array, an h5py dataset or a zarr array),
+            in which case only the footprint of the path is read, one block
+            of channels at a time. If the array is chunked, the blocks of
+            channels are aligned with the chunks and contain at least one
+            chunk along the spectral axis (even if this exceeds
+            ``max_memory``), and only the chunks containing pixels used by
+            the slice are read, each of them once.
+        order : int, optional
+            Spline interpolation order when using line paths. Does not have
+            any effect for polygon paths.
+        respect_nan : bool, optional
+            If set to `False`, NaN values are changed to zero before computing
+            the slices.
+        coefficients : `SplineCoefficients`, optional
+            Precomputed spline coefficients for ``cube``, used for paths with
+            zero width instead of prefiltering the footprint of the path.
+        max_memory : int or :class:`~astropy.units.Quantity`, optional
+            If specified, the spectral axis is processed in blocks of channels
+            such that the memory used for each block is approximately below
+            this value (in bytes, or as a quantity with units of information).
+        chunk_channels : int, optional
+            If specified, the number of channels to process at a time. This
+            takes precedence over ``max_memory``.
+        n_jobs : int, optional
+            The number of tasks to run in parallel (``-1`` to use all CPUs).
+            For paths with zero width, the spectral axis is split into blocks
+            of channels, while for paths with a non-zero width the polygons
+            are split into groups. The result is identical to the serial
+            extraction.
+        executor : {'thread', 'process'} or `~concurrent.futures.Executor`, optional
+            The executor used when ``n_jobs > 1``. By default, a thread pool
+            is used (the interpolation and sparse matrix products release
+            the GIL). When interpolating ``coefficients``, which are shared
+            in memory, a thread pool is used unless an executor instance is
+            given.
+        dtype : `~numpy.dtype`, optional
+            The floating-point data type of the slice. Defaults to the data
+            type of the cube if it is floating-point, and to 64-bit floats
+            otherwise. For line paths, the interpolation is carried out in
+            double precision and rounded once to ``dtype``, while for polygon
+            paths the sums are accumulated in ``dtype`` (see
+            `~pvextractor.geometry.poly_slices.apply_polygon_weights` for the
+            accuracy).
+        spectral_range : tuple, optional
+            The ``(start, stop)`` range of channels to extract, with the same
+            meaning as for a `slice`. Only these channels are read.
+        spectral_bin : int, optional
+            The number of consecutive channels to average in each channel of
+            the slice. If the range of channels is not a multiple of
+            ``spectral_bin``, the last channels are dropped. NaN values are
+            ignored when averaging, and for polygon paths the average is
+            weighted by the area of the polygon covered by finite values.
+        sparse : bool, optional
+            For line paths with ``order`` 0 or 1 or a local interpolation
+            kernel, apply the interpolation as a sparse matrix product (see
+            `line_weights`) instead of interpolating each channel. The
+            matrix is computed once and kept with the plan.
+
+        Returns
+        -------
+        slice : `numpy.ndarray`
+            The (z, n) slice
+        """
+
+        kstart, kstop = get_spectral_channels(spectral_range, cube.shape[0],
+                                              spectral_bin=spectral_bin)
+        nz = (kstop - kstart) // int(spectral_bin)
+
+        total_slice = None
+
+        for channels, block in self.iter_extract(cube, order=order, respect_nan=respect_nan,
+                                                 coefficients=coefficients,
+                                                 max_memory=max_memory,
+                                                 chunk_channels=chunk_channels,
+                                                 n_jobs=n_jobs, executor=executor,
+                                                 dtype=dtype, spectral_range=spectral_range,
+                                                 spectral_bin=spectral_bin, sparse=sparse):
+            if total_slice is None:
+                total_slice = np.zeros((nz, self.n_samples), dtype=block.dtype)
+            total_slice[channels] = block
+
+        if total_slice is None:
+            total_slice = np.zeros((0, self.n_samples),
+                                   dtype=output_dtype(cube.dtype, dtype))
+
+        return total_slice
+
+    def iter_extract(self, cube, order=3, respect_nan=True, coefficients=None,
+                     max_memory=None, chunk_channels=None, n_jobs=1, executor=None,
+                     dtype=None, spectral_range=None, spectral_bin=1, sparse=False):
+        """
+        Extract a slice from a cube with shape (z, y, x) one block of
+        channels at a time.
+
+        This takes the same parameters as `extract`, and yields the blocks of
+        the slice as soon as they are computed, so that only the footprint of
+        the path for one block of channels and the slice for that block are
+        held in memory at a time.
+
+        Yields
+        ------
+        channels : slice
+            The range of channels of the block in the slice (after selecting
+            ``spectral_range`` and binning by ``spectral_bin``)
+        block : `numpy.ndarray`
+            The (z, n) slice for these channels
+        """
+
+        if tuple(cube.shape[1:]) != self.shape:
+            raise ValueError("Cube has spatial shape {0} but plan was computed "
+                             "for shape {1}".format(tuple(cube.shape[1:]), self.shape))
+
+        if self.is_line:
+            _check_order(order)
+
+        cube = self._working_cube(cube, order=order, sparse=sparse)
+
+        kstart, kstop = get_spectral_channels(spectral_range, cube.shape[0],
+                                              spectral_bin=spectral_bin)
+        spectral_bin = int(spectral_bin)
+
+        nz = kstop - kstart
+
+        n_jobs = _n_jobs(n_jobs)
+
+        if (self.is_line and n_jobs > 1
+                and max_memory is None and chunk_channels is None):
+            chunk_channels = int(np.ceil(nz / n_jobs))
+
+        step = self.channels_per_block(nz, order=order, max_memory=max_memory,
+                                       chunk_channels=chunk_channels)
+
+        chunks = chunk_shape(cube)
+        ranges = _channel_blocks(kstart, kstop, step, spectral_bin=spectral_bin,
+                                 chunk=None if chunks is None else chunks[0])
+
+        if self.is_line and coefficients is not None:
+            blocks = self._iter_coefficients(cube, ranges, coefficients, order=order,
+                                             respect_nan=respect_nan, n_jobs=n_jobs,
+                                             executor=executor, dtype=dtype,
+                                             spectral_bin=spectral_bin)
+        else:
+            blocks = self._iter_blocks(cube, ranges, order=order, respect_nan=respect_nan,
+                                       n_jobs=n_jobs, executor=executor, dtype=dtype,
+                                       spectral_bin=spectral_bin, sparse=sparse)
+
+        return ((slice((kmin - kstart) // spectral_bin, (kmax - kstart) // spectral_bin), block)
+                for kmin, kmax, block in blocks)
+
+    def extract_lazy(self, cube, order=3, respect_nan=True, max_memory=None,
+                     chunk_channels=None, dtype=None, spectral_range=None,
+                     spectral_bin=1, sparse=False):
+        """
+        Build a lazy extraction of a slice from a cube with shape (z, y, x),
+        returned as a dask array.
+
+        The slice is computed independently for each block of channels, from
+        the footprint of the path in the cube, so that it can be computed
+        with any dask scheduler (including distributed ones) and composed
+        with other dask computations. Computing the result gives the same
+        values as `extract`.
+
+        Parameters
+        ----------
+        cube : `~numpy.ndarray` or `~dask.array.Array`
+            The data cube to extract the slice from. This can also be an
+            array-like object with a ``dtype`` (see `extract`). The chunks
+            of dask arrays are preserved along the spectral axis, unless
+            ``max_memory`` or ``chunk_channels`` is given.
+        order : int, optional
+            Spline interpolation order when using line paths. Does not have
+            any effect for polygon paths.
+        respect_nan : bool, optional
+            If set to `False`, NaN values are changed to zero before computing
+            the slices.
+        max_memory : int or :class:`~astropy.units.Quantity`, optional
+            The approximate amount of memory to use for each block of
+            channels. For cubes that are not dask arrays, this defaults to
+            the ``array.chunk-size`` setting of dask.
+        chunk_channels : int, optional
+            The number of channels in each block. This takes precedence over
+            ``max_memory``.
+        dtype : `~numpy.dtype`, optional
+            The floating-point data type of the slice (see `extract`).
+        spectral_range : tuple, optional
+            The ``(start, stop)`` range of channels to extract (see
+            `extract`).
+        spectral_bin : int, optional
+            The number of consecutive channels to average in each channel of
+            the slice (see `extract`).
+        sparse : bool, optional
+            Whether to apply the interpolation for line paths as a sparse
+            matrix product (see `extract`).
+
+        Returns
+        -------
+        slice : `~dask.array.Array`
+            The (z, n) slice
+        """
+
+        try:
+            import dask
+            import dask.array as da
+        except ImportError:
+            raise ImportError("dask package required for lazy extraction. "
+                              "Install dask or use extract")
+
+        if tuple(cube.shape[1:]) != self.shape:
+            raise ValueError("Cube has spatial shape {0} but plan was computed "
+                             "for shape {1}".format(tuple(cube.shape[1:]), self.shape))
+
+        if self.is_line:
+            _check_order(order)
+
+        cube = self._working_cube(cube, order=order, sparse=sparse)
+
+        kstart, kstop = get_spectral_channels(spectral_range, cube.shape[0],
+                                              spectral_bin=spectral_bin)
+        spectral_bin = int(spectral_bin)
+
+        nz = kstop - kstart
+        ymin, ymax, xmin, xmax = self.footprint(order=order)
+
+        if isinstance(cube, da.Array):
+            if max_memory is None and chunk_channels is None:
+                step = None
+            else:
+                step = self.channels_per_block(nz, order=order, max_memory=max_memory,
+                                               chunk_channels=chunk_channels)
+        else:
+            if max_memory is None and chunk_channels is None:
+                max_memory = dask.utils.parse_bytes(dask.config.get('array.chunk-size'))
+            step = self.channels_per_block(nz, order=order, max_memory=max_memory,
+                                           chunk_channels=chunk_channels)
+            step = max(step // spectral_bin, 1) * spectral_bin
+            chunks = chunk_shape(cube)
+            if chunks is None:
+                # Split the cube at the edges of the footprint and of the
+                # range of channels so that only these are ever read.
+                chunks = (_split_axis(cube.shape[0], kstart, kstop, step),
+                          _split_axis(self.shape[0], ymin, ymax),
+                          _split_axis(self.shape[1], xmin, xmax))
+            else:
+                # Blocks of whole chunks, so that each chunk is read once
+                align = np.lcm(chunks[0], spectral_bin)
+                chunks = (max(step // align, 1) * align,) + chunks[1:]
+            cube = da.from_array(cube, chunks=chunks, name=False,
+                                 meta=np.empty((0, 0, 0), dtype=cube.dtype))
+
+        cutout = cube[kstart:kstop, ymin:ymax, xmin:xmax]
+
+        if step is None:
+            if spectral_bin > 1:
+                step = max(int(round(cutout.chunks[0][0] / spectral_bin)), 1) * spectral_bin
+            else:
+                step = cutout.chunks[0]
+        else:
+            step = max(step // spectral_bin, 1) * spectral_bin
+
+        cutout = cutout.rechunk((step, -1, -1))
+
+        origin = (ymin, xmin)
+        empty = np.zeros((0,) + cutout.shape[1:], dtype=cutout.dtype)
+        dtype = self._extract_cutout(empty, origin, order=order, respect_nan=respect_nan,
+                                     dtype=dtype, sparse=sparse).dtype
+
+        return cutout.map_blocks(_extract_block, self, origin, order, respect_nan, dtype,
+                                 spectral_bin, sparse, drop_axis=2,
+                                 chunks=(tuple(n // spectral_bin for n in cutout.chunks[0]),
+                                         (self.n_samples,)),
+                                 dtype=dtype, meta=np.empty((0, 0), dtype=dtype))
+
+    def _working_cube(self, cube, order=3, sparse=False):
+        """
+        Return the layout of the cube best suited to the extraction. The
+        spectral-contiguous layout of a `TransposedCube` is used to gather
+        spectra, but interpolation is faster in the original layout.
+        """
+        if (isinstance(cube, TransposedCube) and self.is_line and not sparse
+                and order not in KERNELS and order > 0 and cube.cube is not None):
+            return cube.cube
+        return cube
+
+    def __dask_tokenize__(self):
+        return (type(self).__name__, self.fingerprint)
+
+    def _tasks(self, cube, ranges, order=3, n_groups=1):
+        """
+        Split the extraction into tasks, each covering one of the ``(kmin,
+        kmax)`` ranges of channels in ``ranges`` and (for polygon paths) one
+        of ``n_groups`` groups of polygons, and yield ``(kmin, kmax, rows,
+        cutout, origin)`` tuples. Only the footprint of the path (or of the
+        group of polygons) is read from the cube.
+        """
+
+        ymin, ymax, xmin, xmax = self.footprint(order=order)
+
+        chunks = chunk_shape(cube)
+        tiles = None if chunks is None else self.chunk_tiles(chunks, order=order)
+
+        edges = np.linspace(0, self.n_samples, max(n_groups, 1) + 1).astype(int)
+        groups = [slice(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+        if len(groups) > 1:
+            footprints = [weights_footprint(self.weights[rows], self.shape) for rows in groups]
+        else:
+            groups = [slice(0, self.n_samples)]
+            footprints = [(ymin, ymax, xmin, xmax)]
+
+        for kmin, kmax in ranges:
+            cutout = _read_footprint(cube, kmin, kmax, (ymin, ymax, xmin, xmax), tiles)
+            for rows, (gymin, gymax, gxmin, gxmax) in zip(groups, footprints):
+                gymax, gxmax = max(gymax, gymin), max(gxmax, gxmin)
+                yield (kmin, kmax, rows,
+                       cutout[:, gymin - ymin:gymax - ymin, gxmin - xmin:gxmax - xmin],
+                       (gymin, gxmin))
+
+    def _iter_blocks(self, cube, ranges, order=3, respect_nan=True, n_jobs=1,
+                     executor=None, dtype=None, spectral_bin=1, sparse=False):
+        """
+        Iterate over the ``(kmin, kmax)`` ranges of channels in ``ranges`` and
+        yield ``(kmin, kmax, block)`` tuples, where ``block`` is the slice for channels ``kmin`` to
+        ``kmax`` (binned by ``spectral_bin``). If ``n_jobs > 1`` or an
+        executor is given, the tasks are run in parallel, keeping at most
+        ``2 * n_jobs`` of them in flight. Blocks of channels are split across
+        tasks for line paths, and groups of polygons for polygon paths.
+        """
+
+        n_groups = 1 if self.is_line else n_jobs
+
+        tasks = self._tasks(cube, ranges, order=order, n_groups=n_groups)
+
+        if n_jobs == 1 and executor is None:
+            results = ((kmin, kmax, rows,
+                        _extract_task(self, cutout, origin, order, respect_nan, rows,
+                                      dtype, spectral_bin, sparse))
+                       for kmin, kmax, rows, cutout, origin in tasks)
+        else:
+            results = _run_parallel(self, tasks, order, respect_nan, n_jobs, executor,
+                                    dtype, spectral_bin, sparse)
+
+        current = None
+        for kmin, kmax, rows, block in results:
+            if current is not None and current[0] != kmin:
+                yield tuple(current)
+                current = None
+            if current is None:
+                current = [kmin, kmax, np.zeros((block.shape[0], self.n_samples),
+                                                dtype=block.dtype)]
+            current[2][:, rows] = block
+
+        if current is not None:
+            yield tuple(current)
+
+    def _iter_coefficients(self, cube, ranges, coefficients, order=3, respect_nan=True,
+                           n_jobs=1, executor=None, dtype=None, spectral_bin=1):
+        """
+        Iterate over the ``ranges`` of channels of a line slice interpolated
+        from precomputed spline coefficients, in the same way as
+        `_iter_blocks`. The cube itself is not read. Since the coefficients
+        are shared in memory, blocks are interpolated in parallel in a thread
+        pool unless an executor instance is given.
+        """
+
+        args = (self, cube, coefficients, order, respect_nan, dtype, spectral_bin)
+
+        if n_jobs == 1 and not isinstance(executor, Executor):
+            for kmin, kmax in ranges:
+                yield kmin, kmax, _coefficients_task(kmin, kmax, *args)
+            return
+
+        pool, owned = _get_executor(n_jobs, executor if isinstance(executor, Executor) else None)
+        try:
+            pending = deque()
+            for kmin, kmax in ranges:
+                pending.append((kmin, kmax, pool.submit(_coefficients_task, kmin, kmax, *args)))
+                if len(pending) >= 2 * n_jobs:
+                    kmin, kmax, future = pending.popleft()
+                    yield kmin, kmax, future.result()
+            while pending:
+                kmin, kmax, future = pending.popleft()
+                yield kmin, kmax, future.result()
+        finally:
+            if owned:
+                pool.shutdown()
+
+    def _extract_cutout(self, cutout, origin, order=3, respect_nan=True, rows=None,
+                        dtype=None, spectral_bin=1, sparse=False):
+        """
+        Extract a slice from a cutout of the cube that contains the footprint
+        of the path, and starts at the (y, x) position ``origin``. If ``rows``
+        is given, only these positions along the slice are extracted. The
+        number of channels in the cutout should be a multiple of
+        ``spectral_bin``.
+        """
+
+        if rows is None:
+            rows = slice(0, self.n_samples)
+
+        if cutout.shape[1] == 0 or cutout.shape[2] == 0:
+            n = len(range(self.n_samples)[rows])
+            return np.full((cutout.shape[0] // spectral_bin, n), np.nan,
+                           dtype=output_dtype(cutout.dtype, dtype))
+
+        if self.is_line and sparse:
+            total_slice = apply_line_weights(cutout, self.line_weights(order)[rows],
+                                             shape=self.shape, origin=origin,
+                                             respect_nan=respect_nan, dtype=dtype)
+            return _bin_channels(total_slice, spectral_bin)
+        elif self.is_line:
+            total_slice = extract_line_slice(cutout, self.x[rows] - origin[1],
+                                             self.y[rows] - origin[0],
+                                             order=order, respect_nan=respect_nan,
+                                             dtype=dtype)
+            return _bin_channels(total_slice, spectral_bin)
+        else:
+            total_slice, total_area = apply_polygon_weights(cutout, self.weights[rows],
+                                                            shape=self.shape,
+                                                            origin=origin,
+                                                            respect_nan=respect_nan,
+                                                            dtype=dtype)
+            if spectral_bin > 1:
+                # Sum the weighted values and areas over each bin, so that the
+                # average is weighted by the area covered by finite values.
+                total_slice = _sum_channels(total_slice, spectral_bin)
+                total_area = _sum_channels(total_area, spectral_bin)
+            total_slice[total_area == 0.] = np.nan
+            total_slice[total_area > 0.] /= total_area[total_area > 0.]
+            return total_slice
+
+    def write(self, filename):
+        """
+        Write the plan to a file using pickle.
+        """
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Read a plan previously written with `ExtractionPlan.write`.
+        """
+        with open(filename, 'rb') as f:
+            plan = pickle.load(f)
+        if not isinstance(plan, cls):
+            raise TypeError("File does not contain an ExtractionPlan")
+        return plan
+
+
+def _read_footprint(cube, kmin, kmax, footprint, tiles=None):
+    """
+    Read channels ``kmin`` to ``kmax`` of the footprint of a path in a cube.
+    If ``tiles`` is given, only these parts of the footprint are read, and
+    the rest of the returned cutout is set to zero.
+    """
+
+    ymin, ymax, xmin, xmax = footprint
+
+    if tiles is None:
+        return np.asarray(cube[kmin:kmax, ymin:ymax, xmin:xmax])
+
+    cutout = None
+    for tymin, tymax, txmin, txmax in tiles:
+        tile = np.asarray(cube[kmin:kmax, tymin:tymax, txmin:txmax])
+        if cutout is None:
+            cutout = np.zeros((kmax - kmin, ymax - ymin, xmax - xmin), dtype=tile.dtype)
+        cutout[:, tymin - ymin:tymax - ymin, txmin - xmin:txmax - xmin] = tile
+
+    return cutout
+
+
+def _n_jobs(n_jobs):
+    if n_jobs is None:
+        return 1
+    elif n_jobs < 0:
+        return os.cpu_count() or 1
+    else:
+        return max(int(n_jobs), 1)
+
+
+def _get_executor(n_jobs, executor):
+    """
+    Return an executor, and whether it was created here (and should
+    therefore be shut down after use).
+    """
+    if executor is None or executor == 'thread':
+        return ThreadPoolExecutor(max_workers=n_jobs), True
+    elif executor == 'process':
+        return ProcessPoolExecutor(max_workers=n_jobs), True
+    elif isinstance(executor, Executor):
+        return executor, False
+    else:
+        raise ValueError("executor should be 'thread', 'process', or an "
+                         "Executor instance")
+
+
+def _sum_channels(values, spectral_bin):
+    """
+    Sum a (z, n) array over bins of ``spectral_bin`` channels.
+    """
+    return values.reshape((-1, spectral_bin) + values.shape[1:]).sum(axis=1)
+
+
+def _bin_channels(values, spectral_bin):
+    """
+    Average a (z, n) slice over bins of ``spectral_bin`` channels, ignoring
+    NaN values.
+    """
+    if spectral_bin == 1:
+        return values
+    good = ~np.isnan(values)
+    total = _sum_channels(np.where(good, values, 0), spectral_bin)
+    count = _sum_channels(good.astype(values.dtype), spectral_bin)
+    total[count == 0] = np.nan
+    total[count > 0] /= count[count > 0]
+    return total
+
+
+def _extract_task(plan, cutout, origin, order, respect_nan, rows, dtype=None,
+                  spectral_bin=1, sparse=False):
+    return plan._extract_cutout(cutout, origin, order=order,
+                                respect_nan=respect_nan, rows=rows, dtype=dtype,
+                                spectral_bin=spectral_bin, sparse=sparse)
+
+
+def _coefficients_task(kmin, kmax, plan, cube, coefficients, order, respect_nan,
+                       dtype=None, spectral_bin=1):
+    block = extract_line_slice(cube, plan.x, plan.y, order=order, respect_nan=respect_nan,
+                               coefficients=coefficients, dtype=dtype,
+                               channels=slice(kmin, kmax))
+    return _bin_channels(block, spectral_bin)
+
+
+def _extract_block(cutout, plan, origin, order, respect_nan, dtype=None, spectral_bin=1,
+                   sparse=False):
+    return plan._extract_cutout(cutout, origin, order=order, respect_nan=respect_nan,
+                                dtype=dtype, spectral_bin=spectral_bin, sparse=sparse)
+
+
+def _channel_blocks(kstart, kstop, step, spectral_bin=1, chunk=None):
+    """
+    Split the channels ``kstart`` to ``kstop`` into ``(kmin, kmax)`` ranges
+    of about ``step`` channels, each containing a whole number of bins of
+    ``spectral_bin`` channels.
+
+    If ``chunk`` (the length of the chunks along the spectral axis) is given,
+    the blocks contain a whole number of chunks, starting from the first
+    chunk boundary after ``kstart`` which is also at the edge of a bin (with
+    a shorter leading block before it), so that each chunk is read by only
+    one block.
+    """
+
+    align = spectral_bin if chunk is None else int(np.lcm(chunk, spectral_bin))
+    step = max(step // align, 1) * align
+
+    first = kstart
+    if chunk is not None:
+        boundary = -(-kstart // chunk) * chunk
+        candidates = [k for k in range(boundary, boundary + align, chunk)
+                      if (k - kstart) % spectral_bin == 0]
+        # If no chunk boundary is at the edge of a bin, the blocks can not
+        # be aligned with the chunks, and are counted from kstart instead.
+        if candidates:
+            first = min(candidates[0], kstop)
+
+    ranges = [(kstart, first)] if first > kstart else []
+    ranges += [(kmin, min(kmin + step, kstop)) for kmin in range(first, kstop, step)]
+    return ranges
+
+
+def _split_axis(n, start, stop, step=None):
+    """
+    Return the chunks along an axis of length ``n`` such that ``start`` and
+    ``stop`` fall on chunk boundaries, and the chunks between them have a
+    length of at most ``step``.
+    """
+    inner = [stop - start] if step is None else [min(step, stop - k)
+                                                 for k in range(start, stop, step)]
+    return tuple(c for c in [start] + inner + [n - stop] if c > 0)
+
+
+def _run_parallel(plan, tasks, order, respect_nan, n_jobs, executor, dtype=None,
+                  spectral_bin=1, sparse=False):
+    """
+    Run extraction tasks with an executor and yield the results in order.
+    """
+    pool, owned = _get_executor(n_jobs, executor)
+    try:
+        pending = deque()
+        for kmin, kmax, rows, cutout, origin in tasks:
+            future = pool.submit(_extract_task, plan, cutout, origin, order,
+                                 respect_nan, rows, dtype, spectral_bin, sparse)
+            pending.append((kmin, kmax, rows, future))
+            if len(pending) >= 2 * n_jobs:
+                kmin, kmax, rows, future = pending.popleft()
+                yield kmin, kmax, rows, future.result()
+        while pending:
+            kmin, kmax, rows, future = pending.popleft()
+            yield kmin, kmax, rows, future.result()
+    finally:
+        if owned:
+            pool.shutdown()
+
+
+class PlanCache(object):
+    """
+    A least-recently-used cache of `ExtractionPlan` objects, keyed by the
+    fingerprint of their geometry.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of plans to keep. Set to zero to disable caching.
+    """
+
+    def __init__(self, maxsize=16):
+        self._plans = OrderedDict()
+        self._maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        """
+        The maximum number of plans to keep.
+        """
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, value):
+        self._maxsize = value
+        self._evict()
+
+    def __len__(self):
+        return len(self._plans)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self._plans
+
+    def _evict(self):
+        while len(self._plans) > max(self._maxsize, 0):
+            self._plans.popitem(last=False)
+
+    def add(self, plan):
+        """
+        Add a plan (for example one read from disk) to the cache.
+        """
+        self._plans[plan.fingerprint] = plan
+        self._plans.move_to_end(plan.fingerprint)
+        self._evict()
+
+    def get(self, path, spacing, shape, wcs=None, engine='vectorized',
+            template_resolution=None):
+        """
+        Return the plan for the given geometry, computing it if needed.
+        """
+        fingerprint = plan_fingerprint(path, spacing, shape, wcs=wcs, engine=engine,
+                                       template_resolution=template_resolution)
+        if fingerprint in self._plans:
+            self.hits += 1
+            self._plans.move_to_end(fingerprint)
+            return self._plans[fingerprint]
+        self.misses += 1
+        plan = ExtractionPlan(path, spacing, shape, wcs=wcs, engine=engine,
+                              template_resolution=template_resolution)
+        self.add(plan)
+        return plan
+
+    def clear(self):
+        """
+        Remove all plans from the cache and reset the counters.
+        """
+        self._plans.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+plan_cache = PlanCache()
+
+
+def get_extraction_plan(path, spacing, shape, wcs=None, engine='vectorized',
+                        template_resolution=None):
+    """
+    Return the `ExtractionPlan` for the given geometry, using the in-process
+    cache (``plan_cache``).
+    """
+    return plan_cache.get(path, spacing, shape, wcs=wcs, engine=engine,
+                          template_resolution=template_resolution)
@@ -1,29 +1,225 @@
 from __future__ import print_function
 
 import numpy as np
+from scipy import sparse
 from astropy.utils.console import ProgressBar
 
-from .polygon import square_polygon_overlap_area
+from .polygon import square_polygon_overlap_area, square_polygon_overlap_areas
+from .line_slices import output_dtype
 
+ENGINES = ('vectorized', 'matplotlib')
 
-def extract_poly_slice(cube, polygons, return_area=False):
+# Maximum number of (polygon, pixel) pairs clipped at once by the vectorized
+# engine, which bounds the size of the temporary arrays.
+MAX_PAIRS = 2 ** 18
+
+# Tolerance (in pixels) below which polygons are considered to be translated
+# copies of each other, and therefore share the same overlap template.
+TEMPLATE_TOLERANCE = 1e-10
+
+
+def _polygon_vertices(polygons):
     """
-    Extract the values of polygonal chunks from a data cube
+    Return the vertices of the polygons as (n, m) arrays, padding polygons
+    with fewer vertices by repeating their last vertex.
+    """
+    m = max(len(polygon.x) for polygon in polygons)
+    x = np.zeros((len(polygons), m))
+    y = np.zeros((len(polygons), m))
+    for i, polygon in enumerate(polygons):
+        k = len(polygon.x)
+        x[i, :k] = polygon.x
+        y[i, :k] = polygon.y
+        x[i, k:] = polygon.x[-1]
+        y[i, k:] = polygon.y[-1]
+    return x, y
 
-    Parameters
-    ----------
-    cube : np.ndarray
-    polygons : 
-    return_area : bool
-        If set, return the area of each polygon and the sum over that area.
-        Otherwise, return the mean.
+
+def _bounding_boxes(x, y, shape):
+    """
+    Find the range of pixels that might overlap with each polygon, clipped to
+    an image with the given (ny, nx) shape.
+    """
+
+    # Find bounding box
+    bbxmin = np.round(np.min(x, axis=1)).astype(int) - 1
+    bbxmax = np.round(np.max(x, axis=1)).astype(int) + 2
+    bbymin = np.round(np.min(y, axis=1)).astype(int) - 1
+    bbymax = np.round(np.max(y, axis=1)).astype(int) + 2
+
+    # Clip to cube box
+    bbxmin = np.maximum(bbxmin, 0)
+    bbxmax = np.minimum(bbxmax, shape[1])
+    bbymin = np.maximum(bbymin, 0)
+    bbymax = np.minimum(bbymax, shape[0])
+
+    return bbxmin, bbxmax, bbymin, bbymax
+
+
+def _overlaps_vectorized(x, y, shape):
+
+    bbxmin, bbxmax, bbymin, bbymax = _bounding_boxes(x, y, shape)
+
+    nbx = np.maximum(bbxmax - bbxmin, 0)
+    nby = np.maximum(bbymax - bbymin, 0)
+    npairs = nbx * nby
+
+    index, xpix, ypix, area = [], [], [], []
+
+    # Process the polygons in groups to limit memory usage
+    end = np.cumsum(npairs)
+    start = 0
+    while start < len(x):
+
+        stop = np.searchsorted(end, end[start] - npairs[start] + MAX_PAIRS,
+                               side='right')
+        stop = max(stop, start + 1)
+
+        counts = npairs[start:stop]
+        idx = np.repeat(np.arange(start, stop), counts)
+
+        if len(idx) == 0:
+            start = stop
+            continue
+        offset = np.arange(len(idx)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        xp = bbxmin[idx] + offset // nby[idx]
+        yp = bbymin[idx] + offset % nby[idx]
+
+        a = square_polygon_overlap_areas(xp - 0.5, xp + 0.5,
+                                         yp - 0.5, yp + 0.5,
+                                         x[idx], y[idx])
+
+        keep = a > 0
+        index.append(idx[keep])
+        xpix.append(xp[keep])
+        ypix.append(yp[keep])
+        area.append(a[keep])
+
+        start = stop
+
+    if len(index) == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, empty, np.zeros(0)
+
+    return (np.hstack(index).astype(int), np.hstack(ypix).astype(int),
+            np.hstack(xpix).astype(int), np.hstack(area))
+
+
+def _axis_aligned(x, y):
+    """
+    Return a boolean array indicating which polygons are rectangles with
+    edges parallel to the pixel axes (to within ``TEMPLATE_TOLERANCE``).
+    """
+    if x.shape[1] != 4:
+        return np.zeros(len(x), dtype=bool)
+    dx = np.abs(np.roll(x, -1, axis=1) - x) < TEMPLATE_TOLERANCE
+    dy = np.abs(np.roll(y, -1, axis=1) - y) < TEMPLATE_TOLERANCE
+    # Consecutive edges should alternate between vertical and horizontal
+    return (np.all(dx[:, ::2] & dy[:, 1::2], axis=1) |
+            np.all(dy[:, ::2] & dx[:, 1::2], axis=1))
+
+
+def _overlaps_rectangles(x, y, shape):
     """
+    Compute the overlaps of axis-aligned rectangles with the pixels directly,
+    as the product of the overlaps of the pixel rows and columns with the
+    sides of each rectangle.
+
+    This avoids clipping, but every pixel covered by a rectangle is still
+    returned with its weight, so the cost is proportional to the number of
+    covered pixels (about the length times the width of the path), both here
+    and for each channel when the weights are applied to the cube.
+    """
+
+    xmin, xmax = np.min(x, axis=1), np.max(x, axis=1)
+    ymin, ymax = np.min(y, axis=1), np.max(y, axis=1)
+
+    # Range of pixels covered by each rectangle, clipped to the image
+    bbxmin = np.maximum(np.floor(xmin + 0.5).astype(int), 0)
+    bbxmax = np.minimum(np.ceil(xmax + 0.5).astype(int), shape[1])
+    bbymin = np.maximum(np.floor(ymin + 0.5).astype(int), 0)
+    bbymax = np.minimum(np.ceil(ymax + 0.5).astype(int), shape[0])
+
+    nbx = np.maximum(bbxmax - bbxmin, 0)
+    nby = np.maximum(bbymax - bbymin, 0)
+    counts = nbx * nby
+
+    index = np.repeat(np.arange(len(x)), counts)
+    offset = np.arange(len(index)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    xpix = bbxmin[index] + offset // nby[index]
+    ypix = bbymin[index] + offset % nby[index]
+
+    wx = np.minimum(xmax[index], xpix + 0.5) - np.maximum(xmin[index], xpix - 0.5)
+    wy = np.minimum(ymax[index], ypix + 0.5) - np.maximum(ymin[index], ypix - 0.5)
+    area = np.maximum(wx, 0) * np.maximum(wy, 0)
+
+    keep = area > 0
+
+    return index[keep], ypix[keep], xpix[keep], area[keep]
+
+
+def _overlaps_templates(x, y, shape, resolution=None):
+    """
+    Compute the overlaps of polygons which are translated copies of each
+    other (as along straight parts of a path) only once.
+
+    Polygons are grouped by shape and by the fractional part of the position
+    of their first vertex, which is rounded to ``resolution`` pixels (by
+    default ``TEMPLATE_TOLERANCE``). The overlaps are computed once for each
+    group, and shifted by the integer part of the position of each polygon.
+    """
+
+    tolerance = TEMPLATE_TOLERANCE if resolution is None else resolution
+
+    x0 = np.floor(x[:, 0])
+    y0 = np.floor(y[:, 0])
+
+    # Shape of the polygons and fractional offset of their first vertex
+    shapes = np.round(np.hstack([x - x[:, :1], y - y[:, :1]]) / TEMPLATE_TOLERANCE)
+    fx = np.round((x[:, 0] - x0) / tolerance)
+    fy = np.round((y[:, 0] - y0) / tolerance)
+
+    keys = np.hstack([shapes, fx[:, np.newaxis], fy[:, np.newaxis]])
+    keys, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+
+    if resolution is None and len(keys) == len(x):
+        return _overlaps_vectorized(x, y, shape)
+
+    # Templates, translated such that all their vertices are at positive
+    # coordinates in a virtual image.
+    tx = x[first] - x[first, :1] + fx[first, np.newaxis] * tolerance
+    ty = y[first] - y[first, :1] + fy[first, np.newaxis] * tolerance
+    shift = int(np.ceil(max(-tx.min(), -ty.min(), 0))) + 2
+    tx += shift
+    ty += shift
+    size = int(np.ceil(max(tx.max(), ty.max()))) + 3
+
+    tindex, typix, txpix, tarea = _overlaps_vectorized(tx, ty, (size, size))
+
+    # Expand the templates for each polygon
+    order = np.argsort(tindex, kind='stable')
+    tindex, typix, txpix, tarea = tindex[order], typix[order], txpix[order], tarea[order]
+    counts = np.bincount(tindex, minlength=len(keys))[inverse]
+    starts = np.searchsorted(tindex, np.arange(len(keys)))[inverse]
 
-    nx = len(polygons)
-    nz = cube.shape[0]
+    index = np.repeat(np.arange(len(x)), counts)
+    rows = (np.arange(len(index)) - np.repeat(np.cumsum(counts) - counts, counts)
+            + np.repeat(starts, counts))
 
-    total_slice = np.zeros((nz, nx))
-    total_area = np.zeros((nz, nx))
+    ypix = typix[rows] + (y0[index] - shift).astype(int)
+    xpix = txpix[rows] + (x0[index] - shift).astype(int)
+
+    keep = (xpix >= 0) & (ypix >= 0) & (xpix < shape[1]) & (ypix < shape[0])
+
+    return index[keep], ypix[keep], xpix[keep], tarea[rows][keep]
+
+
+def _overlaps_matplotlib(polygons, shape):
+
+    index, xpix, ypix, area = [], [], [], []
 
     p = ProgressBar(len(polygons))
 
@@ -31,38 +227,222 @@ def extract_poly_slice(cube, polygons, return_area=False):
 
         p.update()
 
-        # Find bounding box
-        bbxmin = int(round(np.min(polygon.x))-1)
-        bbxmax = int(round(np.max(polygon.x))+2)
-        bbymin = int(round(np.min(polygon.y))-1)
-        bbymax = int(round(np.max(polygon.y))+2)
-
-        # Clip to cube box
-        bbxmin = max(bbxmin, 0)
-        bbxmax = min(bbxmax, cube.shape[2])
-        bbymin = max(bbymin, 0)
-        bbymax = min(bbymax, cube.shape[1])
+        x, y = _polygon_vertices([polygon])
+        bbxmin, bbxmax, bbymin, bbymax = [b[0] for b in _bounding_boxes(x, y, shape)]
 
         # Loop through pixels that might overlap
         for xmin in np.arange(bbxmin, bbxmax):
             for ymin in np.arange(bbymin, bbymax):
 
-                area = square_polygon_overlap_area(xmin-0.5, xmin+0.5,
-                                                   ymin-0.5, ymin+0.5,
-                                                   polygon.x, polygon.y)
+                a = square_polygon_overlap_area(xmin-0.5, xmin+0.5,
+                                                ymin-0.5, ymin+0.5,
+                                                polygon.x, polygon.y)
+
+                if a > 0:
+                    index.append(i)
+                    xpix.append(xmin)
+                    ypix.append(ymin)
+                    area.append(a)
+
+    print("")
+
+    return (np.array(index, dtype=int), np.array(ypix, dtype=int),
+            np.array(xpix, dtype=int), np.array(area, dtype=float))
+
+
+def polygon_pixel_overlaps(polygons, shape, engine='vectorized', template_resolution=None):
+    """
+    Find the area of overlap between polygons and the pixels of an image
+
+    Parameters
+    ----------
+    polygons : list of `Polygon`
+        The polygons, in pixel coordinates
+    shape : tuple
+        The (ny, nx) shape of the image
+    engine : {'vectorized', 'matplotlib'}
+        Whether to clip all candidate pixels of all polygons at once using
+        NumPy, or to loop over pixels and clip them one at a time with
+        Matplotlib. The ``'vectorized'`` engine computes the overlaps of
+        rectangles parallel to the pixel axes directly (without clipping,
+        but still for every covered pixel), only clips polygons
+        which are not translated copies of another polygon (as along
+        straight parts of a path), and reuses the overlaps of the others.
+        Only paths with a width are made of polygons, so this does not cover
+        paths without a width, which are sampled by spline interpolation
+        instead, even along the pixel axes.
+    template_resolution : float, optional
+        If specified, the positions of polygons with the same shape are
+        rounded to this fraction of a pixel (for example ``0.01``) when
+        looking for translated copies, so that the overlaps of polygons along
+        straight parts of a path with any direction are only computed for at
+        most ``1 / template_resolution ** 2`` polygons. Each overlap area is
+        then accurate to about ``template_resolution`` times the length of
+        the edges of the polygon inside the pixel. By default, only exact
+        copies (to within ``1e-10`` pixels) are reused. Only used by the
+        ``'vectorized'`` engine.
+
+    Returns
+    -------
+    index, ypix, xpix, area : `~numpy.ndarray`
+        The index of the polygon, the pixel coordinates, and the overlap area
+        for each pair of polygon and pixel that overlap.
+    """
+
+    if engine not in ENGINES:
+        raise ValueError("engine should be one of {0}".format(', '.join(ENGINES)))
+
+    if len(polygons) == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, empty, np.zeros(0)
+
+    if engine == 'vectorized':
+        x, y = _polygon_vertices(polygons)
+        aligned = _axis_aligned(x, y)
+        if not np.any(aligned):
+            return _overlaps_templates(x, y, shape, resolution=template_resolution)
+        # Polygons along parts of the path parallel to the pixel axes are
+        # rectangles, whose overlaps can be computed without any clipping.
+        overlaps = [_overlaps_rectangles(x[aligned], y[aligned], shape)]
+        if not np.all(aligned):
+            overlaps.append(_overlaps_templates(x[~aligned], y[~aligned], shape,
+                                                resolution=template_resolution))
+        index = np.hstack([np.nonzero(subset)[0][overlap[0]] for subset, overlap
+                           in zip((aligned, ~aligned), overlaps)])
+        ypix, xpix, area = [np.hstack([overlap[i] for overlap in overlaps])
+                            for i in (1, 2, 3)]
+        return index, ypix, xpix, area
+    else:
+        return _overlaps_matplotlib(polygons, shape)
+
+
+def polygon_weights(polygons, shape, engine='vectorized', template_resolution=None):
+    """
+    Compile the overlap between polygons and the pixels of an image into a
+    sparse matrix
+
+    Parameters
+    ----------
+    polygons : list of `Polygon`
+        The polygons, in pixel coordinates
+    shape : tuple
+        The (ny, nx) shape of the image
+    engine : {'vectorized', 'matplotlib'}
+        The engine used to compute the overlaps (see
+        `polygon_pixel_overlaps`).
+    template_resolution : float, optional
+        The resolution used to reuse the overlaps of translated polygons (see
+        `polygon_pixel_overlaps`).
+
+    Returns
+    -------
+    weights : `~scipy.sparse.csr_matrix`
+        A (n_polygons, ny * nx) matrix containing the area of overlap between
+        each polygon and each pixel of the flattened image.
+    """
+    index, ypix, xpix, area = polygon_pixel_overlaps(polygons, shape, engine=engine,
+                                                     template_resolution=template_resolution)
+    return sparse.csr_matrix((area, (index, ypix * shape[1] + xpix)),
+                             shape=(len(polygons), shape[0] * shape[1]))
+
+
+def weights_footprint(weights, shape):
+    """
+    Find the range of pixels with a non-zero weight in a (n, ny * nx) weight
+    matrix, for an image with the given (ny, nx) shape.
+
+    Returns
+    -------
+    ymin, ymax, xmin, xmax : int
+        The bounds of the footprint
+    """
+    if weights.nnz == 0:
+        return 0, 0, 0, 0
+    ypix, xpix = np.unravel_index(weights.indices, shape)
+    return ypix.min(), ypix.max() + 1, xpix.min(), xpix.max() + 1
+
+
+def apply_polygon_weights(cube, weights, shape=None, origin=(0, 0), respect_nan=True,
+                          dtype=None):
+    """
+    Sum the values of a cube weighted by a sparse (n, ny * nx) weight matrix,
+    ignoring non-finite values.
+
+    Parameters
+    ----------
+    cube : `~numpy.ndarray`
+        The (nz, ny, nx) cube, or a cutout from it.
+    weights : `~scipy.sparse.csr_matrix`
+        The weight matrix
+    shape : tuple, optional
+        The (ny, nx) shape of the image the weights are defined for, if
+        ``cube`` is a cutout.
+    origin : tuple, optional
+        The (y, x) position of the first pixel of the cutout in the image.
+    respect_nan : bool, optional
+        If set to `False`, NaN values are treated as zeros (only the pixels
+        with a non-zero weight are copied).
+    dtype : `~numpy.dtype`, optional
+        The floating-point data type in which the sums are accumulated (see
+        `~pvextractor.geometry.line_slices.output_dtype` for the default).
+        When summing ``m`` pixels, the relative error of each sum is at most
+        about ``m`` times the machine epsilon of ``dtype`` (1.2e-7 for 32-bit
+        floats), and typically ``sqrt(m)`` times the machine epsilon.
+
+    Returns
+    -------
+    total_slice, total_area : `~numpy.ndarray`
+        The (nz, n) weighted sum of the finite values, and the sum of the
+        weights of the finite values.
+    """
+
+    dtype = output_dtype(cube.dtype, dtype)
+
+    # Only read the pixels that have a non-zero weight
+    columns = np.unique(weights.indices)
+    weights = weights[:, columns].astype(dtype)
+    ypix, xpix = np.unravel_index(columns, shape or cube.shape[1:])
+
+    # Gather the spectra of these pixels as a (n_pixels, nz) array, which is
+    # fastest if the spectra are contiguous in memory (see TransposedCube).
+    spectra = np.moveaxis(cube, 0, -1)[ypix - origin[0], xpix - origin[1]]
+    spectra = spectra.astype(dtype, copy=False)
+    if not respect_nan:
+        spectra = np.nan_to_num(spectra)
+    good_values = np.isfinite(spectra)
+
+    total_slice = np.ascontiguousarray((weights @ np.where(good_values, spectra, 0)).T)
+    total_area = np.ascontiguousarray((weights @ good_values.astype(dtype)).T)
+
+    return total_slice, total_area
 
-                if area > 0:
-                    dataslice = cube[:, ymin, xmin]
-                    good_values = np.isfinite(dataslice)
-                    if np.any(good_values):
-                        total_slice[good_values, i] += dataslice[good_values] * area
-                        total_area[good_values, i] += area
+
+def extract_poly_slice(cube, polygons, return_area=False, engine='vectorized', dtype=None):
+    """
+    Extract the values of polygonal chunks from a data cube
+
+    Parameters
+    ----------
+    cube : np.ndarray
+    polygons :
+    return_area : bool
+        If set, return the area of each polygon and the sum over that area.
+        Otherwise, return the mean.
+    engine : {'vectorized', 'matplotlib'}
+        The engine used to compute the overlap between polygons and pixels
+        (see `polygon_pixel_overlaps`).
+    dtype : `~numpy.dtype`, optional
+        The floating-point data type of the slice, in which the values are
+        also accumulated (see `apply_polygon_weights`).
+    """
+
+    weights = polygon_weights(polygons, cube.shape[1:], engine=engine)
+
+    total_slice, total_area = apply_polygon_weights(cube, weights, dtype=dtype)
 
     total_slice[total_area == 0.] = np.nan
     if return_area:
         return total_slice, total_area
     total_slice[total_area > 0.] /= total_area[total_area > 0.]
 
-    print("")
-
     return total_slice
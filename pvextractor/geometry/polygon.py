@@ -35,3 +35,81 @@ def square_polygon_overlap_area(xmin, xmax, ymin, ymax, x, y):
         return 0.
     else:
         return polygon_area(x, y)
+
+
+def _clip_half_plane(x, y, value):
+    """
+    Clip a set of polygons, stored as (n, m) arrays of vertices, to the half
+    plane where ``value`` (evaluated at each vertex) is positive, using the
+    Sutherland-Hodgman algorithm. Polygons with fewer than ``m`` vertices are
+    padded by repeating their last vertex.
+    """
+
+    xp = np.roll(x, 1, axis=1)
+    yp = np.roll(y, 1, axis=1)
+    vp = np.roll(value, 1, axis=1)
+
+    inside = value >= 0
+    crossing = inside != (vp >= 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(crossing, vp / (vp - value), 0.)
+
+    # Each edge emits the intersection point (if the edge crosses the
+    # boundary) followed by its end vertex (if it is inside)
+    xc = np.stack([xp + t * (x - xp), x], axis=2).reshape(len(x), -1)
+    yc = np.stack([yp + t * (y - yp), y], axis=2).reshape(len(y), -1)
+    valid = np.stack([crossing, inside], axis=2).reshape(len(x), -1)
+
+    # Move the emitted vertices to the front of each row
+    order = np.argsort(~valid, axis=1, kind='stable')
+    count = valid.sum(axis=1)
+    m = max(count.max(), 1)
+    xc = np.take_along_axis(xc, order[:, :m], axis=1)
+    yc = np.take_along_axis(yc, order[:, :m], axis=1)
+
+    # Pad with the last emitted vertex, which does not change the area
+    last = np.maximum(count - 1, 0)[:, np.newaxis]
+    column = np.minimum(np.arange(m)[np.newaxis, :], last)
+    xc = np.take_along_axis(xc, column, axis=1)
+    yc = np.take_along_axis(yc, column, axis=1)
+
+    # Empty polygons collapse to a single point
+    xc[count == 0] = 0.
+    yc[count == 0] = 0.
+
+    return xc, yc
+
+
+def square_polygon_overlap_areas(xmin, xmax, ymin, ymax, x, y):
+    """
+    Vectorized version of `square_polygon_overlap_area`.
+
+    Parameters
+    ----------
+    xmin, xmax, ymin, ymax : `~numpy.ndarray`
+        The (n,) bounds of the squares
+    x, y : `~numpy.ndarray`
+        The (n, m) vertices of the polygons to intersect with each square
+
+    Returns
+    -------
+    area : `~numpy.ndarray`
+        The (n,) overlap areas
+    """
+
+    x = np.array(x, dtype=float, ndmin=2)
+    y = np.array(y, dtype=float, ndmin=2)
+
+    xmin, xmax, ymin, ymax = [np.asarray(b, dtype=float)[:, np.newaxis]
+                              for b in (xmin, xmax, ymin, ymax)]
+
+    x, y = _clip_half_plane(x, y, x - xmin)
+    x, y = _clip_half_plane(x, y, xmax - x)
+    x, y = _clip_half_plane(x, y, y - ymin)
+    x, y = _clip_half_plane(x, y, ymax - y)
+
+    x2 = np.roll(x, -1, axis=1)
+    y2 = np.roll(y, -1, axis=1)
+
+    return np.abs(0.5 * np.sum(x * y2 - x2 * y, axis=1))
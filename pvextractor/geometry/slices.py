@@ -1,15 +1,16 @@
-import numpy as np
-
-from .line_slices import extract_line_slice
-from .poly_slices import extract_poly_slice
+from ..utils.wcs_utils import get_spectral_channels
+from .plan import ExtractionPlan, get_extraction_plan
 
 
 def extract_slice(cube, path, spacing=1.0, order=3, respect_nan=True,
-                  wcs=None):
+                  wcs=None, engine='vectorized', coefficients=None,
+                  max_memory=None, chunk_channels=None, n_jobs=1, executor=None,
+                  lazy=False, dtype=None, spectral_range=None, spectral_bin=1,
+                  template_resolution=None, sparse=False):
     """
     Given an array with shape (z, y, x), extract a (z, n) slice from a path
     with ``n`` segments.
-    
+
     All units are in *pixels*
 
     .. note:: If there are NaNs in the cube, they will be treated as zeros when
@@ -17,31 +18,129 @@ def extract_slice(cube, path, spacing=1.0, order=3, respect_nan=True,
 
     Parameters
     ----------
-    path : `Path`
-        The path along which to define the slice
+    path : `Path` or `ExtractionPlan`
+        The path along which to define the slice. The pixel-space geometry
+        of the path is looked up in (or added to) the in-process plan cache.
+        If an `ExtractionPlan` is given, ``spacing``, ``wcs``, ``engine`` and
+        ``template_resolution`` are ignored.
     spacing : float
         The position resolution in the final slice
-    order : int, optional
-        Spline interpolation order when using line paths. Does not have any
-        effect for polygon paths.
+    order : int or {'keys', 'lanczos'}, optional
+        Spline interpolation order when using line paths, or local
+        interpolation kernel which only uses the 4x4 pixels around each
+        sample and does not require prefiltering the cube (see
+        `~pvextractor.geometry.line_slices.extract_line_slice`). Does not
+        have any effect for polygon paths.
     respect_nan : bool, optional
         If set to `False`, NaN values are changed to zero before computing
         the slices.
+    wcs : :class:`~astropy.wcs.WCS`, optional
+        The WCS transformation needed if the path is defined in world
+        coordinates.
+    engine : {'vectorized', 'matplotlib'}, optional
+        The engine used to compute the overlap between the polygons and the
+        pixels when using polygon paths. The ``'vectorized'`` engine clips
+        all pixels at once and gives the same areas as the (much slower)
+        ``'matplotlib'`` engine. Does not have any effect for line paths.
+    coefficients : `~pvextractor.geometry.line_slices.SplineCoefficients`, optional
+        Precomputed spline coefficients of the cube for the same ``order``,
+        which avoids prefiltering the cube when extracting many line slices.
+        Does not have any effect for polygon paths.
+    max_memory : int or :class:`~astropy.units.Quantity`, optional
+        If specified, the spectral axis is processed in blocks of channels
+        such that the memory used for each block is approximately below this
+        value (in bytes, or as a quantity with units of information such as
+        ``u.GB``). This allows slices to be extracted from memory-mapped cubes
+        that do not fit in memory.
+    chunk_channels : int, optional
+        If specified, the number of channels to process at a time. This takes
+        precedence over ``max_memory``.
+    n_jobs : int, optional
+        The number of tasks to run in parallel (``-1`` to use all CPUs). For
+        line paths, the spectral axis is split into blocks of channels, while
+        for polygon paths the polygons are split into groups. The result is
+        identical to the serial extraction.
+    executor : {'thread', 'process'} or `~concurrent.futures.Executor`, optional
+        The executor used when ``n_jobs > 1``. By default, a thread pool is
+        used.
+    lazy : bool, optional
+        If `True`, return a dask array which computes the slice one block of
+        channels at a time when it is computed (see
+        `ExtractionPlan.extract_lazy`). ``cube`` can then also be a dask
+        array, and ``n_jobs`` and ``executor`` are ignored since the
+        computation is run by the dask scheduler.
+    dtype : `~numpy.dtype`, optional
+        The floating-point data type of the slice. Defaults to the data type
+        of the cube if it is floating-point (so that for example 32-bit cubes
+        give 32-bit slices), and to 64-bit floats otherwise. Line paths are
+        interpolated in double precision and rounded once to ``dtype``. For
+        polygon paths the sums are accumulated in ``dtype``, and the relative
+        error on each value is at most about ``m`` times the machine epsilon
+        of ``dtype`` (1.2e-7 for 32-bit floats) for polygons covering ``m``
+        pixels.
+    spectral_range : tuple, optional
+        The ``(start, stop)`` range of the spectral axis to extract, either as
+        channel indices (with the same meaning as for a `slice`), or as
+        quantities with spectral units (in which case ``wcs`` should be
+        given, and the channels with centers in the range are used). Only
+        these channels are read from the cube.
+    spectral_bin : int, optional
+        The number of consecutive channels to average in each channel of the
+        slice. If the number of channels is not a multiple of
+        ``spectral_bin``, the last channels are dropped. NaN values are
+        ignored when averaging, and for polygon paths the average is weighted
+        by the area covered by finite values.
+    template_resolution : float, optional
+        For polygon paths, the overlaps of polygons along straight parts of
+        the path are only computed once for polygons that are translated
+        copies of each other. If specified, the positions of the polygons are
+        rounded to this fraction of a pixel (for example ``0.01``) when
+        looking for copies, which makes computing the geometry of long
+        straight paths much faster at the cost of overlap areas accurate to
+        about ``template_resolution`` pixels (see
+        `~pvextractor.geometry.poly_slices.polygon_pixel_overlaps`).
+    sparse : bool, optional
+        For line paths with ``order`` 0 or 1 or a local interpolation kernel,
+        compile the interpolation into a sparse matrix, which is kept with
+        the plan and applied to the spectra of the pixels near the path in a
+        single product, instead of interpolating each channel separately.
+        This is faster for cubes with many channels, and when extracting the
+        same path from several cubes.
+
+    Notes
+    -----
+    Only the part of the cube covered by the path (padded as needed for
+    spline interpolation) is used, so the cost of the extraction scales with
+    the footprint of the path rather than the size of the image. For spline
+    interpolation with ``order > 1``, the padding is chosen such that the
+    result differs from interpolating in the full image by less than
+    :math:`10^{-12}` times the values in the cube.
 
     Returns
     -------
-    slice : `numpy.ndarray`
+    slice : `numpy.ndarray` or `~dask.array.Array`
         The slice
     """
 
-    if not respect_nan:
-        cube = np.nan_to_num(cube)
-
-    if path.width is None:
-        x, y = path.sample_points(spacing=spacing, wcs=wcs)
-        slice = extract_line_slice(cube, x, y, order=order)
+    if isinstance(path, ExtractionPlan):
+        plan = path
     else:
-        polygons = path.sample_polygons(spacing=spacing, wcs=wcs)
-        slice = extract_poly_slice(cube, polygons)
+        plan = get_extraction_plan(path, spacing, cube.shape, wcs=wcs, engine=engine,
+                                   template_resolution=template_resolution)
+
+    spectral_range = get_spectral_channels(spectral_range, cube.shape[0], wcs=wcs,
+                                           spectral_bin=spectral_bin)
+
+    if lazy:
+        if coefficients is not None:
+            raise ValueError("coefficients cannot be used for lazy extraction")
+        return plan.extract_lazy(cube, order=order, respect_nan=respect_nan,
+                                 max_memory=max_memory, chunk_channels=chunk_channels,
+                                 dtype=dtype, spectral_range=spectral_range,
+                                 spectral_bin=spectral_bin, sparse=sparse)
 
-    return slice
+    return plan.extract(cube, order=order, respect_nan=respect_nan,
+                        coefficients=coefficients, max_memory=max_memory,
+                        chunk_channels=chunk_channels, n_jobs=n_jobs,
+                        executor=executor, dtype=dtype, spectral_range=spectral_range,
+                        spectral_bin=spectral_bin, sparse=sparse)
@@ -0,0 +1,134 @@
+import pytest
+import numpy as np
+from numpy.testing import assert_allclose
+from scipy.ndimage import map_coordinates
+
+from ..line_slices import extract_line_slice, SplineCoefficients
+
+
+def reference_line_slice(cube, x, y, order):
+    # Interpolation in three dimensions, as originally implemented
+    nz = cube.shape[0]
+    zi = np.outer(np.arange(nz, dtype=int), np.ones(len(x)))
+    xi = np.outer(np.ones(nz), x)
+    yi = np.outer(np.ones(nz), y)
+    total_slice = map_coordinates(np.nan_to_num(cube), [zi, yi, xi],
+                                  order=order, cval=np.nan)
+    slice_bad = map_coordinates(np.nan_to_num(np.isnan(cube).astype(int)),
+                                [zi, yi, xi], order=order)
+    total_slice[np.nonzero(slice_bad)] = np.nan
+    return total_slice
+
+
+@pytest.mark.parametrize('order', (1, 2, 3, 5))
+def test_spatial_interpolation(order):
+
+    np.random.seed(12345)
+
+    cube = np.random.random((6, 20, 25))
+    cube[2, 10, 12] = np.nan
+
+    x = np.random.uniform(-1, 25, 50)
+    y = np.random.uniform(-1, 20, 50)
+
+    expected = reference_line_slice(cube, x, y, order)
+    actual = extract_line_slice(cube, x, y, order=order)
+
+    assert_allclose(actual, expected, atol=1e-12)
+
+
+@pytest.mark.parametrize('background', (False, True))
+def test_spline_coefficients(background):
+
+    np.random.seed(12345)
+
+    cube = np.random.random((6, 20, 25))
+    cube[2, 10, 12] = np.nan
+
+    x = np.random.uniform(-1, 25, 50)
+    y = np.random.uniform(-1, 20, 50)
+
+    coefficients = SplineCoefficients(cube, order=3, background=background)
+
+    expected = extract_line_slice(cube, x, y, order=3)
+    actual = extract_line_slice(cube, x, y, order=3, coefficients=coefficients)
+    assert coefficients.ready
+    assert_allclose(actual, expected, atol=1e-12)
+
+    expected = extract_line_slice(np.nan_to_num(cube), x, y, order=3)
+    actual = extract_line_slice(cube, x, y, order=3, coefficients=coefficients,
+                                respect_nan=False)
+    assert_allclose(actual, expected, atol=1e-12)
+
+    with pytest.raises(ValueError) as exc:
+        extract_line_slice(cube, x, y, order=2, coefficients=coefficients)
+    assert exc.value.args[0] == "Spline coefficients were computed for order=3"
+
+
+@pytest.mark.parametrize('order', (0, 1, 3))
+def test_respect_nan(order):
+
+    np.random.seed(12345)
+
+    cube = np.random.random((6, 20, 25))
+    cube[2, 10, 12] = np.nan
+    cube[3, 1, 1] = np.nan
+
+    x = np.random.uniform(-1, 25, 50)
+    y = np.random.uniform(-1, 20, 50)
+
+    expected = extract_line_slice(np.nan_to_num(cube), x, y, order=order)
+    actual = extract_line_slice(cube, x, y, order=order, respect_nan=False)
+    assert_allclose(actual, expected)
+
+    if order > 0:
+        expected = reference_line_slice(cube, x, y, order)
+        actual = extract_line_slice(cube, x, y, order=order)
+        assert_allclose(actual, expected, atol=1e-12)
+
+
+@pytest.mark.parametrize('kernel', ('keys', 'lanczos'))
+def test_kernels(kernel):
+
+    np.random.seed(12345)
+
+    yy, xx = np.mgrid[0:20, 0:30]
+    cube = np.array([1 + 0.3 * xx + 0.2 * yy + 0.01 * xx * yy + 0.02 * xx ** 2,
+                     np.sin(xx / 5.) * np.cos(yy / 7.)])
+
+    x = np.random.uniform(1, 27, 50)
+    y = np.random.uniform(1, 17, 50)
+
+    total_slice = extract_line_slice(cube, x, y, order=kernel)
+
+    # Cubic convolution reproduces quadratic functions exactly
+    if kernel == 'keys':
+        assert_allclose(total_slice[0], 1 + 0.3 * x + 0.2 * y + 0.01 * x * y + 0.02 * x ** 2)
+
+    assert_allclose(total_slice[1], np.sin(x / 5.) * np.cos(y / 7.), atol=0.01)
+
+    # Samples on pixel centers give the pixel values, and samples outside
+    # the cube are NaN
+    total_slice = extract_line_slice(cube, np.array([0., 4., 29., 29.5]),
+                                     np.array([0., 7., 19., 3.]), order=kernel)
+    assert_allclose(total_slice[:, :3], cube[:, [0, 7, 19], [0, 4, 29]])
+    assert np.all(np.isnan(total_slice[:, 3]))
+
+    # As for spline interpolation, samples are NaN where the interpolated
+    # mask of NaN values rounds to a non-zero value
+    cube[1, 10, 10:12] = np.nan
+    total_slice = extract_line_slice(cube, np.array([10., 10.5, 11.5, 14.]),
+                                     np.array([10., 10.2, 10.5, 10.]), order=kernel)
+    assert np.all(np.isnan(total_slice[1, :2]))
+    assert np.all(np.isfinite(total_slice[0]))
+    assert np.all(np.isfinite(total_slice[1, 2:]))
+
+    total_slice = extract_line_slice(cube, np.array([10.5]), np.array([10.2]),
+                                     order=kernel, respect_nan=False)
+    assert np.all(np.isfinite(total_slice))
+
+
+def test_invalid_kernel():
+    with pytest.raises(ValueError) as exc:
+        extract_line_slice(np.ones((2, 4, 4)), np.array([1.]), np.array([1.]), order='cubic')
+    assert exc.value.args[0] == "order should be an integer or one of keys, lanczos"
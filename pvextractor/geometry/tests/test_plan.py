@@ -0,0 +1,499 @@
+import warnings
+import pytest
+import numpy as np
+from astropy import units as u
+from astropy.wcs import WCS
+from numpy.testing import assert_allclose
+
+from ..path import Path
+from ..plan import ExtractionPlan, PlanCache, plan_cache
+from ..slices import extract_slice
+from ..line_slices import extract_line_slice
+from ..poly_slices import extract_poly_slice
+from ...utils.wcs_utils import get_spectral_channels
+
+
+# A path with three points crossing the cubes made by make_cube_and_plan
+PATH_XY = [(5.5, 4.5), (30.5, 20.5), (40.5, 35.)]
+
+
+def make_cube_and_plan(width, nz=7, dtype=np.float64):
+    """
+    Return a random (nz, 40, 50) cube containing NaN values, and the plan for
+    the path along ``PATH_XY`` with the given width.
+    """
+
+    np.random.seed(12345)
+
+    cube = np.random.random((nz, 40, 50)).astype(dtype)
+    cube[1, 20:22, 10:15] = np.nan
+
+    plan = ExtractionPlan(Path(PATH_XY, width=width), 0.5, cube.shape)
+
+    return cube, plan
+
+
+@pytest.mark.parametrize('width', (None, 1.5))
+def test_plan_extract(width):
+
+    np.random.seed(12345)
+
+    cube = np.random.random((4, 15, 18))
+
+    path = Path([(1.2, 2.1), (9.7, 6.4), (13.3, 10.2)], width=width)
+
+    plan = ExtractionPlan(path, 0.8, cube.shape)
+
+    if width is None:
+        x, y = path.sample_points(spacing=0.8)
+        expected = extract_line_slice(cube, x, y, order=3)
+    else:
+        expected = extract_poly_slice(cube, path.sample_polygons(spacing=0.8))
+
+    assert plan.n_samples == expected.shape[1]
+    assert_allclose(plan.extract(cube), expected)
+    assert_allclose(extract_slice(cube, plan), expected)
+
+
+def test_plan_shape_mismatch():
+    plan = ExtractionPlan(Path([(1., 1.), (5., 5.)]), 1., (10, 10))
+    with pytest.raises(ValueError) as exc:
+        plan.extract(np.zeros((3, 10, 11)))
+    assert exc.value.args[0] == ("Cube has spatial shape (10, 11) but plan "
+                                 "was computed for shape (10, 10)")
+
+
+def test_plan_read_write(tmp_path):
+
+    cube = np.random.random((4, 15, 18))
+
+    plan = ExtractionPlan(Path([(1.2, 2.1), (13.3, 10.2)], width=2.), 0.8, cube.shape)
+    plan.write(tmp_path / 'plan.pkl')
+
+    plan2 = ExtractionPlan.read(tmp_path / 'plan.pkl')
+
+    assert plan2.fingerprint == plan.fingerprint
+    assert_allclose(plan2.extract(cube), plan.extract(cube))
+
+
+def test_plan_cache():
+
+    cache = PlanCache(maxsize=2)
+
+    path1 = Path([(1., 1.), (5., 5.)])
+    path2 = Path([(1., 1.), (5., 6.)])
+
+    plan = cache.get(path1, 1., (10, 10))
+    assert cache.get(path1, 1., (10, 10)) is plan
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Changing any part of the geometry gives a new plan
+    assert cache.get(path1, 0.5, (10, 10)) is not plan
+    assert cache.get(path2, 1., (10, 10)) is not plan
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert len(cache) == 2
+    assert plan.fingerprint not in cache
+
+    # Modifying the path in-place also gives a new plan
+    path2.add_point((7., 7.))
+    assert cache.get(path2, 1., (10, 10)).n_samples > plan.n_samples
+
+    # The template resolution is only part of the geometry of wide paths
+    path3 = Path([(1., 1.), (5., 5.)], width=2.)
+    plan3 = cache.get(path3, 1., (10, 10))
+    assert cache.get(path3, 1., (10, 10), template_resolution=0.01) is not plan3
+    assert cache.get(path1, 1., (10, 10), template_resolution=0.01).n_samples == plan.n_samples
+
+    cache.maxsize = 1
+    assert len(cache) == 1
+
+    cache.clear()
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_extract_slice_uses_cache():
+
+    cube = np.random.random((4, 15, 18))
+    path = Path([(1.2, 2.1), (13.3, 10.2)], width=2.)
+
+    plan_cache.clear()
+    extract_slice(cube, path)
+    extract_slice(cube * 2, path)
+    assert (plan_cache.hits, plan_cache.misses) == (1, 1)
+
+
+@pytest.mark.parametrize(('width', 'order'), ((None, 0), (None, 1), (None, 3), (None, 5), (2.5, 3)))
+def test_plan_footprint(width, order):
+
+    np.random.seed(12345)
+
+    cube = np.random.random((3, 150, 160))
+    cube[1, 60:62, 70:75] = np.nan
+
+    path = Path([(50.5, 40.5), (70.5, 60.5), (90.5, 65.)], width=width)
+
+    plan = ExtractionPlan(path, 0.5, cube.shape)
+
+    ymin, ymax, xmin, xmax = plan.footprint(order=order)
+    assert (ymax - ymin) * (xmax - xmin) < 150 * 160 / 2
+
+    if width is None:
+        expected = extract_line_slice(cube, plan.x, plan.y, order=order)
+    else:
+        expected = extract_poly_slice(cube, path.sample_polygons(spacing=0.5))
+
+    assert_allclose(plan.extract(cube, order=order), expected, atol=1e-11)
+
+    expected = plan.extract(np.nan_to_num(cube), order=order)
+    assert_allclose(plan.extract(cube, order=order, respect_nan=False), expected)
+
+
+def test_plan_outside():
+    plan = ExtractionPlan(Path([(-10., -10.), (-5., -5.)], width=1.), 1., (10, 10))
+    assert np.all(np.isnan(plan.extract(np.ones((3, 10, 10)))))
+    plan = ExtractionPlan(Path([(-10., -10.), (-5., -5.)]), 1., (10, 10))
+    assert np.all(np.isnan(plan.extract(np.ones((3, 10, 10)))))
+
+
+@pytest.mark.parametrize('width', (None, 2.5))
+def test_plan_chunked(tmp_path, width):
+
+    cube, plan = make_cube_and_plan(width)
+
+    memmap = np.lib.format.open_memmap(tmp_path / 'cube.npy', mode='w+',
+                                       dtype=cube.dtype, shape=cube.shape)
+    memmap[...] = cube
+
+    expected = plan.extract(cube)
+
+    assert plan.channels_per_block(7, chunk_channels=3) == 3
+    assert plan.channels_per_block(7, max_memory=2 * plan.bytes_per_channel()) == 2
+    assert plan.channels_per_block(7, max_memory=1) == 1
+    assert plan.channels_per_block(7) == 7
+
+    assert_allclose(plan.extract(memmap, chunk_channels=3), expected)
+    assert_allclose(plan.extract(memmap, max_memory=3 * u.kB), expected)
+    assert_allclose(extract_slice(memmap, plan, chunk_channels=1), expected)
+
+
+@pytest.mark.parametrize(('width', 'order'), ((None, 0), (None, 1), (None, 3), (2.5, 3)))
+def test_plan_dtype(width, order):
+
+    cube, plan = make_cube_and_plan(width)
+
+    expected = plan.extract(cube.astype(np.float32).astype(np.float64), order=order)
+
+    # Float32 cubes give float32 slices by default
+    result = plan.extract(cube.astype(np.float32), order=order)
+    assert result.dtype == np.float32
+    assert_allclose(result, expected, rtol=1e-6)
+
+    result = plan.extract(cube.astype(np.float32), order=order, dtype=np.float64)
+    assert result.dtype == np.float64
+    if width is None:
+        np.testing.assert_array_equal(result, expected)
+    else:
+        assert_allclose(result, expected, rtol=1e-14)
+
+    # Integer cubes (which cannot contain NaN values) give float64 slices
+    integers = np.random.randint(-1000, 1000, cube.shape).astype(np.int16)
+    result = plan.extract(integers, order=order)
+    assert result.dtype == np.float64
+    np.testing.assert_array_equal(result, plan.extract(integers.astype(np.float64), order=order))
+
+    assert plan.extract(cube, order=order, dtype=np.float32, n_jobs=2).dtype == np.float32
+
+    with pytest.raises(ValueError) as exc:
+        plan.extract(cube, order=order, dtype=int)
+    assert exc.value.args[0] == "dtype should be a floating-point data type"
+
+
+@pytest.mark.parametrize('cdelt', (1000., -1000.))
+def test_plan_spectral_range_half_open(cdelt):
+
+    # Ranges in spectral units with a missing bound extend to the first or
+    # last channel, whichever way the spectral axis goes
+    cube, plan = make_cube_and_plan(2.5, nz=9)
+    expected = plan.extract(cube)
+
+    wcs = WCS(naxis=3)
+    wcs.wcs.ctype = ['RA---CAR', 'DEC--CAR', 'VELO-HEL']
+    wcs.wcs.cunit = ['deg', 'deg', 'm/s']
+    wcs.wcs.crpix = [1., 1., 1.]
+    wcs.wcs.cdelt = [-0.01, 0.01, cdelt]
+    wcs.wcs.crval = [0., 0., -321000.]
+
+    velocity = (-321000. + 3.2 * cdelt) * u.m / u.s
+
+    assert get_spectral_channels((None, velocity), 9, wcs=wcs) == (0, 4)
+    assert get_spectral_channels((velocity.to(u.km / u.s), None), 9, wcs=wcs) == (4, 9)
+    assert get_spectral_channels((None, velocity), 9, wcs=wcs, spectral_bin=3) == (0, 3)
+
+    spectral_range = get_spectral_channels((velocity, None), 9, wcs=wcs)
+    np.testing.assert_array_equal(plan.extract(cube, spectral_range=spectral_range),
+                                  expected[4:])
+
+
+@pytest.mark.parametrize(('width', 'order'), ((None, 0), (None, 1), (None, 3), (2.5, 3)))
+def test_plan_spectral_range_bin(width, order):
+
+    cube, plan = make_cube_and_plan(width, nz=13)
+    cube[5] = np.nan
+
+    expected = plan.extract(cube, order=order)
+
+    np.testing.assert_array_equal(plan.extract(cube, order=order, spectral_range=(2, 11)),
+                                  expected[2:11])
+
+    result = plan.extract(cube, order=order, spectral_range=(2, 11), spectral_bin=4)
+    assert result.shape == (2, plan.n_samples)
+
+    if width is None:
+        # Channel 5 is all NaN and is ignored in the average
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            assert_allclose(result, np.nanmean(expected[2:10].reshape(2, 4, -1), axis=1))
+    else:
+        # The average is weighted by the area covered by finite values
+        polygons = Path(PATH_XY, width=width).sample_polygons(spacing=0.5)
+        total, area = extract_poly_slice(cube[2:10], polygons, return_area=True)
+        with np.errstate(invalid='ignore'):
+            total = np.nan_to_num(total).reshape(2, 4, -1).sum(1)
+            assert_allclose(result, total / area.reshape(2, 4, -1).sum(1))
+
+    np.testing.assert_array_equal(plan.extract(cube, order=order, spectral_range=(2, 11),
+                                               spectral_bin=4, chunk_channels=3), result)
+    np.testing.assert_array_equal(plan.extract(cube, order=order, spectral_range=(2, 11),
+                                               spectral_bin=4, n_jobs=2), result)
+
+    with pytest.raises(ValueError) as exc:
+        plan.extract(cube, spectral_bin=0)
+    assert exc.value.args[0] == "spectral_bin should be a positive integer"
+
+
+class ChunkedArray(object):
+    """
+    Array-like object with a chunk layout, which records the chunks read.
+    """
+
+    def __init__(self, data, chunks):
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.chunks = chunks
+        self.reads = []
+
+    def __getitem__(self, view):
+        # Indices of all the chunks overlapping the view along each axis
+        indices = []
+        for index, n, chunk in zip(view, self.shape, self.chunks):
+            start, stop, _ = index.indices(n)
+            indices.append(range(start // chunk, (stop - 1) // chunk + 1))
+        for k in indices[0]:
+            for j in indices[1]:
+                for i in indices[2]:
+                    self.reads.append((k, j, i))
+        return self.data[view]
+
+
+@pytest.mark.parametrize(('width', 'order'),
+                         ((None, 0), (None, 1), (None, 3), (None, 'keys'), (2.5, 3)))
+def test_plan_chunk_aware(width, order):
+
+    cube, plan = make_cube_and_plan(width)
+
+    expected = plan.extract(cube, order=order)
+
+    if width is None:
+        # Only the footprint of the path is used
+        assert_allclose(expected, extract_line_slice(cube, plan.x, plan.y, order=order))
+
+    chunked = ChunkedArray(cube, (2, 8, 8))
+    np.testing.assert_array_equal(plan.extract(chunked, order=order, chunk_channels=5), expected)
+
+    # The blocks of channels are aligned with the chunks, and each chunk is
+    # read at most once
+    assert len(chunked.reads) == len(set(chunked.reads))
+
+    if order == 3 and width is None:
+        assert plan.chunk_tiles(chunked.chunks, order=order) is None
+    else:
+        # Chunks away from the path are not read
+        tiles = plan.chunk_tiles(chunked.chunks, order=order)
+        assert len(tiles) < 24
+        assert len(chunked.reads) == 4 * len(tiles)
+
+
+@pytest.mark.parametrize('width', (None, 2.5))
+@pytest.mark.parametrize(('spectral_range', 'spectral_bin'), (((3, 13), 1), ((2, 12), 2)))
+def test_plan_chunk_reads_h5py(tmp_path, width, spectral_range, spectral_bin):
+
+    h5py = pytest.importorskip('h5py')
+
+    cube, plan = make_cube_and_plan(width, nz=13)
+
+    expected = plan.extract(cube, order=1, spectral_range=spectral_range,
+                            spectral_bin=spectral_bin)
+
+    with h5py.File(tmp_path / 'cube.h5', 'w') as f:
+        dataset = f.create_dataset('cube', data=cube, chunks=(4, 8, 8))
+        chunked = ChunkedArray(dataset, dataset.chunks)
+        # The range starts in the middle of a chunk, and the blocks would be
+        # smaller than a chunk, but each chunk is still read once
+        result = plan.extract(chunked, order=1, spectral_range=spectral_range,
+                              spectral_bin=spectral_bin, chunk_channels=2)
+        np.testing.assert_array_equal(result, expected)
+
+    assert len(chunked.reads) > 0
+    assert len(chunked.reads) == len(set(chunked.reads))
+    kmin, kmax = spectral_range
+    assert {k for k, j, i in chunked.reads} == set(range(kmin // 4, (kmax - 1) // 4 + 1))
+
+
+@pytest.mark.parametrize('width', (None, 2.5))
+def test_plan_h5py_zarr(tmp_path, width):
+
+    h5py = pytest.importorskip('h5py')
+    zarr = pytest.importorskip('zarr')
+
+    cube, plan = make_cube_and_plan(width)
+
+    expected = plan.extract(cube, order=1)
+
+    with h5py.File(tmp_path / 'cube.h5', 'w') as f:
+        dataset = f.create_dataset('cube', data=cube, chunks=(2, 8, 8))
+        np.testing.assert_array_equal(plan.extract(dataset, order=1), expected)
+
+    array = zarr.create_array(store=str(tmp_path / 'cube.zarr'), shape=cube.shape,
+                              chunks=(2, 8, 8), dtype=cube.dtype)
+    array[...] = cube
+    np.testing.assert_array_equal(plan.extract(array, order=1), expected)
+
+
+@pytest.mark.parametrize(('width', 'order'), ((None, 0), (None, 1), (None, 3), (2.5, 3)))
+def test_plan_lazy(width, order):
+
+    da = pytest.importorskip('dask.array')
+
+    cube, plan = make_cube_and_plan(width)
+
+    expected = plan.extract(cube, order=order)
+
+    result = plan.extract_lazy(cube, order=order, chunk_channels=3)
+    assert isinstance(result, da.Array)
+    assert result.chunks == ((3, 3, 1), (plan.n_samples,))
+    np.testing.assert_array_equal(result.compute(), expected)
+
+    # Spectral chunks of dask arrays are preserved by default
+    result = extract_slice(da.from_array(cube, chunks=(2, 16, 16)), plan,
+                           order=order, lazy=True)
+    assert result.chunks == ((2, 2, 2, 1), (plan.n_samples,))
+    np.testing.assert_array_equal(result.compute(), expected)
+
+    # Only the chunks of array-likes overlapping the footprint are read
+    chunked = ChunkedArray(cube, (7, 8, 8))
+    np.testing.assert_array_equal(plan.extract_lazy(chunked, order=order).compute(),
+                                  expected)
+    ymin, ymax, xmin, xmax = plan.footprint(order=order)
+    n_tiles = ((ymax - 1) // 8 - ymin // 8 + 1) * ((xmax - 1) // 8 - xmin // 8 + 1)
+    assert len(chunked.reads) == n_tiles
+
+
+def test_plan_lazy_coefficients():
+    pytest.importorskip('dask')
+    with pytest.raises(ValueError) as exc:
+        extract_slice(np.zeros((3, 40, 50)), Path([(5.5, 4.5), (30.5, 20.5)]),
+                      lazy=True, coefficients=object())
+    assert exc.value.args[0] == "coefficients cannot be used for lazy extraction"
+
+
+@pytest.mark.parametrize(('width', 'executor'), ((None, 'thread'), (None, 'process'),
+                                                 (2.5, 'thread'), (2.5, 'process')))
+def test_plan_parallel(width, executor):
+
+    cube, plan = make_cube_and_plan(width)
+
+    expected = plan.extract(cube)
+
+    np.testing.assert_array_equal(plan.extract(cube, n_jobs=3, executor=executor), expected)
+    np.testing.assert_array_equal(plan.extract(cube, n_jobs=2, executor=executor,
+                                               chunk_channels=2), expected)
+
+
+def test_plan_parallel_invalid_executor():
+    plan = ExtractionPlan(Path([(5.5, 4.5), (30.5, 20.5)]), 0.5, (40, 50))
+    with pytest.raises(ValueError) as exc:
+        plan.extract(np.zeros((3, 40, 50)), n_jobs=2, executor='mpi')
+    assert exc.value.args[0] == "executor should be 'thread', 'process', or an Executor instance"
+
+
+@pytest.mark.parametrize(('width', 'order'), ((None, 0), (None, 1), (None, 3), (2.5, 3)))
+def test_plan_transposed_cube(tmp_path, width, order):
+
+    from ...utils.readers import TransposedCube
+
+    cube, plan = make_cube_and_plan(width, dtype=np.float32)
+
+    expected = plan.extract(cube, order=order)
+
+    transposed = TransposedCube(cube, max_memory=1000)
+    assert transposed.shape == cube.shape
+    assert transposed.spectra.shape == (40, 50, 7)
+    np.testing.assert_array_equal(transposed[2:5, 10:20, 3], cube[2:5, 10:20, 3])
+    np.testing.assert_array_equal(np.asarray(transposed), cube)
+
+    np.testing.assert_array_equal(plan.extract(transposed, order=order), expected)
+    np.testing.assert_array_equal(plan.extract(transposed, order=order, chunk_channels=2),
+                                  expected)
+
+    # The copy can be stored on disk and reopened
+    TransposedCube(cube, filename=tmp_path / 'cube.npy')
+    reopened = TransposedCube.open(tmp_path / 'cube.npy')
+    np.testing.assert_array_equal(plan.extract(reopened, order=order), expected)
+
+    # The data type of cubes read from FITS files is preserved
+    from astropy.io import fits
+    from ...utils.readers import FITSReader
+    fits.PrimaryHDU(cube).writeto(tmp_path / 'cube.fits')
+    with fits.open(tmp_path / 'cube.fits') as hdulist:
+        transposed = TransposedCube(FITSReader(hdulist[0]))
+        assert transposed.dtype == np.float32
+        np.testing.assert_array_equal(plan.extract(transposed, order=order), expected)
+
+
+@pytest.mark.parametrize('order', (0, 1, 'keys', 'lanczos'))
+def test_plan_sparse(order):
+
+    np.random.seed(12345)
+
+    cube = np.random.random((6, 30, 40))
+    cube[1, 10:14, 10:15] = np.nan
+
+    plan = ExtractionPlan(Path([(-2.5, 4.3), (20.5, 15.5), (35.2, 31.)]), 0.7, cube.shape)
+
+    expected = plan.extract(cube, order=order)
+
+    assert_allclose(plan.extract(cube, order=order, sparse=True), expected, atol=1e-12)
+    assert_allclose(plan.extract(cube, order=order, sparse=True, chunk_channels=4,
+                                 spectral_bin=2),
+                    plan.extract(cube, order=order, chunk_channels=4, spectral_bin=2),
+                    atol=1e-12)
+    assert_allclose(plan.extract(cube, order=order, sparse=True, respect_nan=False),
+                    plan.extract(cube, order=order, respect_nan=False), atol=1e-12)
+
+    # The interpolation weights are computed once and kept with the plan
+    assert plan.line_weights(order) is plan.line_weights(order)
+    assert plan.line_weights(order).shape == (plan.n_samples, 30 * 40)
+
+    assert_allclose(extract_line_slice(cube, plan.x, plan.y, order=order, sparse=True),
+                    expected, atol=1e-12)
+
+
+def test_plan_sparse_invalid():
+
+    plan = ExtractionPlan(Path([(1., 1.), (5., 5.)]), 1., (10, 10))
+    with pytest.raises(ValueError) as exc:
+        plan.extract(np.ones((2, 10, 10)), order=3, sparse=True)
+    assert exc.value.args[0] == ("Sparse interpolation weights can only be computed "
+                                 "for order 0 or 1, or for a local kernel")
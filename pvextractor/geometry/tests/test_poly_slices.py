@@ -0,0 +1,151 @@
+import pytest
+import numpy as np
+from numpy.testing import assert_allclose
+
+from ..path import Path
+from ..polygon import square_polygon_overlap_area, square_polygon_overlap_areas
+from ..poly_slices import extract_poly_slice, polygon_pixel_overlaps, polygon_weights
+
+
+def test_square_polygon_overlap_areas():
+
+    np.random.seed(12345)
+
+    n = 200
+
+    xmin = np.random.randint(-3, 3, n) - 0.5
+    ymin = np.random.randint(-3, 3, n) - 0.5
+
+    # Random rotated rectangles
+    theta = np.random.uniform(0, 2 * np.pi, n)
+    length = np.random.uniform(0.1, 3, n)
+    width = np.random.uniform(0.001, 3, n)
+    x0 = np.random.uniform(-3, 3, n)
+    y0 = np.random.uniform(-3, 3, n)
+    dx, dy = np.cos(theta), np.sin(theta)
+    x = np.transpose([x0 - dy * width, x0 + dx * length - dy * width,
+                      x0 + dx * length + dy * width, x0 + dy * width])
+    y = np.transpose([y0 + dx * width, y0 + dy * length + dx * width,
+                      y0 + dy * length - dx * width, y0 - dx * width])
+
+    expected = [square_polygon_overlap_area(xmin[i], xmin[i] + 1,
+                                            ymin[i], ymin[i] + 1,
+                                            x[i], y[i]) for i in range(n)]
+
+    area = square_polygon_overlap_areas(xmin, xmin + 1, ymin, ymin + 1, x, y)
+
+    assert_allclose(area, expected, atol=1e-12)
+
+
+@pytest.mark.parametrize('width', (0.001, 1.3, 5.))
+def test_engines_consistent(width):
+
+    np.random.seed(12345)
+
+    cube = np.random.random((3, 20, 30))
+    cube[1, 5:8, 10:12] = np.nan
+
+    path = Path([(2.2, 3.1), (15.7, 9.4), (20.3, 17.2), (28., 12.)], width=width)
+    polygons = path.sample_polygons(spacing=0.7)
+
+    overlaps1 = polygon_pixel_overlaps(polygons, cube.shape[1:], engine='vectorized')
+    overlaps2 = polygon_pixel_overlaps(polygons, cube.shape[1:], engine='matplotlib')
+
+    order1 = np.lexsort(overlaps1[:3])
+    order2 = np.lexsort(overlaps2[:3])
+    for a1, a2 in zip(overlaps1, overlaps2):
+        assert_allclose(a1[order1], a2[order2], atol=1e-12)
+
+    slice1 = extract_poly_slice(cube, polygons, engine='vectorized')
+    slice2 = extract_poly_slice(cube, polygons, engine='matplotlib')
+
+    assert_allclose(slice1, slice2)
+
+
+@pytest.mark.parametrize('template_resolution', (None, 0.01))
+def test_polygon_templates(template_resolution):
+
+    # Straight paths along the axes with integer spacing give translated
+    # copies of the same polygon, so the overlaps of only one of them are
+    # computed, while the overlaps of other paths are approximated to within
+    # the template resolution.
+
+    shape = (20, 40)
+    atol = 1e-9 if template_resolution is None else 2 * template_resolution
+
+    for vertices, spacing in [([(-1.7, 3.4), (45.3, 3.4)], 1.),
+                              ([(5.2, -2.3), (5.2, 25.1)], 2.),
+                              ([(2.2, 3.1), (15.7, 9.4), (20.3, 17.2), (38., 12.)], 0.7)]:
+
+        polygons = Path(vertices, width=2.3).sample_polygons(spacing=spacing)
+
+        weights = polygon_weights(polygons, shape, template_resolution=template_resolution)
+        expected = polygon_weights(polygons, shape, engine='matplotlib')
+
+        assert_allclose(weights.toarray(), expected.toarray(), atol=atol)
+
+
+def test_axis_aligned():
+
+    # Polygons along rows and columns are rectangles whose overlaps are
+    # computed without clipping, including along paths that leave the image
+    # and paths that also have segments in other directions.
+
+    np.random.seed(12345)
+
+    cube = np.random.random((3, 20, 40))
+    cube[1, 5:8, 10:12] = np.nan
+
+    for vertices in [[(-1.7, 3.4), (45.3, 3.4), (45.3, 15.2), (20.1, 15.2)],
+                     [(5.2, -2.3), (5.2, 25.1)],
+                     [(2.2, 3.1), (15.7, 3.1), (20.3, 17.2), (20.3, 8.)]]:
+
+        polygons = Path(vertices, width=2.3).sample_polygons(spacing=0.7)
+
+        weights = polygon_weights(polygons, cube.shape[1:])
+        expected = polygon_weights(polygons, cube.shape[1:], engine='matplotlib')
+
+        assert_allclose(weights.toarray(), expected.toarray(), atol=1e-12)
+
+        assert_allclose(extract_poly_slice(cube, polygons),
+                        extract_poly_slice(cube, polygons, engine='matplotlib'))
+
+
+def test_invalid_engine():
+    polygons = Path([(0., 0.), (3., 3.)], width=1.).sample_polygons(spacing=1.)
+    with pytest.raises(ValueError) as exc:
+        extract_poly_slice(np.ones((2, 4, 4)), polygons, engine='shapely')
+    assert exc.value.args[0] == "engine should be one of vectorized, matplotlib"
+
+
+def test_polygon_weights():
+
+    np.random.seed(12345)
+
+    cube = np.random.random((4, 12, 15))
+    cube[2, 3:6, 4:9] = np.nan
+
+    path = Path([(1.2, 2.1), (9.7, 6.4), (13.3, 10.2)], width=2.5)
+    polygons = path.sample_polygons(spacing=1.3)
+
+    weights = polygon_weights(polygons, cube.shape[1:])
+
+    assert weights.shape == (len(polygons), 12 * 15)
+
+    # The weights for each polygon should add up to the polygon area if it is
+    # fully inside the image
+    assert_allclose(weights.sum(axis=1), 2.5 * 1.3)
+
+    total_slice, total_area = extract_poly_slice(cube, polygons, return_area=True)
+
+    # Reference computed with an explicit loop over pixels
+    index, ypix, xpix, area = polygon_pixel_overlaps(polygons, cube.shape[1:])
+    expected_slice = np.zeros((4, len(polygons)))
+    expected_area = np.zeros((4, len(polygons)))
+    for i, y, x, a in zip(index, ypix, xpix, area):
+        good = np.isfinite(cube[:, y, x])
+        expected_slice[good, i] += cube[good, y, x] * a
+        expected_area[good, i] += a
+
+    assert_allclose(total_slice, expected_slice)
+    assert_allclose(total_area, expected_area)
@@ -12,7 +12,12 @@ from matplotlib.transforms import Bbox
 from matplotlib.patches import Polygon
 
 from .geometry.path import Path, get_endpoints
-from . import extract_pv_slice
+from .geometry.line_slices import SplineCoefficients
+from . import IncrementalExtractor
+
+# Cubes whose spline coefficients would take more memory than this (in bytes)
+# are interpolated in the footprint of each path instead.
+PRECOMPUTE_MAX_MEMORY = 2 ** 28
 
 
 def distance(x1, y1, x2, y2, x3, y3):
@@ -244,10 +249,35 @@ def with_rc_defaults(func):
 
 
 class PVSlicer(object):
+    """
+    Interactive extraction of position-velocity slices from a cube.
+
+    Parameters
+    ----------
+    filename_or_cube : str or :class:`~spectral_cube.SpectralCube` or HDU
+        The cube to display and extract slices from.
+    backend : str, optional
+        The Matplotlib backend to use.
+    clim : tuple, optional
+        The limits of the color scale.
+    cmap : str, optional
+        The colormap to use.
+    precompute : bool, optional
+        Whether to compute the spline coefficients of the whole cube in the
+        background, so that slices along boxes without a width only require
+        sampling them rather than prefiltering the footprint of the path
+        (boxes with a width are integrated over pixels and do not use the
+        coefficients). The coefficients take
+        at least as much memory as the cube, so by default they are only
+        computed if they take at most ``PRECOMPUTE_MAX_MEMORY`` bytes.
+        Slices extracted before the coefficients are ready do not wait for
+        them.
+    """
 
     @set_mpl_backend
     @with_rc_defaults
-    def __init__(self, filename_or_cube, backend=None, clim=None, cmap=None):
+    def __init__(self, filename_or_cube, backend=None, clim=None, cmap=None,
+                 precompute=None):
 
         try:
             from spectral_cube.spectral_cube import SpectralCube, BaseSpectralCube
@@ -267,6 +297,21 @@ class PVSlicer(object):
             if self.array.ndim != 3:
                 raise ValueError("dataset does not have 3 dimensions (install the spectral_cube package to avoid this error)")
 
+        # Compute the spline coefficients of the cube in the background, so
+        # that extracting each new slice only requires sampling them.
+        if precompute is None:
+            itemsize = np.dtype(getattr(self.array, 'dtype', np.float64)).itemsize
+            precompute = int(np.prod(self.shape)) * itemsize <= PRECOMPUTE_MAX_MEMORY
+        if precompute and len(self.shape) == 3:
+            self.coefficients = SplineCoefficients(self.array, order=3, background=True)
+        else:
+            self.coefficients = None
+
+        # Slices are extracted incrementally, so that only the columns along
+        # the new parts of a path that is extended are computed.
+        self.extractor = None
+        self._extractor_coefficients = None
+
         import matplotlib.pyplot as plt
 
         self.fig = plt.figure(figsize=(8, 5))
@@ -405,10 +450,24 @@ class PVSlicer(object):
     @with_rc_defaults
     def update_pv_slice(self, box):
 
+        # Boxes without a width are line paths, which are interpolated from
+        # the spline coefficients (if any) rather than from the cube.
         path = Path(zip(box.x, box.y))
-        path.width = box.width
+        path.width = box.width or None
+
+        # The coefficients are only used once they are ready, so that the
+        # first slices do not wait for them.
+        if self.coefficients is not None and self.coefficients.ready:
+            coefficients = self.coefficients
+        else:
+            coefficients = None
+
+        if self.extractor is None or self._extractor_coefficients is not coefficients:
+            self.extractor = IncrementalExtractor(self.array, order=3,
+                                                  coefficients=coefficients)
+            self._extractor_coefficients = coefficients
 
-        self.pv_slice = extract_pv_slice(self.array, path)
+        self.pv_slice = self.extractor.extract(path)
 
         self.ax2.cla()
         self.ax2.imshow(self.pv_slice.data, origin='lower', aspect='auto',
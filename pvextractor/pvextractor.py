@@ -6,14 +6,24 @@ import warnings
 from astropy import units as u
 from astropy.io.fits import PrimaryHDU, ImageHDU, Header
 
-from .utils.wcs_utils import get_spatial_scale, sanitize_wcs
+from .utils.wcs_utils import get_spatial_scale, sanitize_wcs, get_spectral_channels
 from .geometry import extract_slice
+from .geometry.plan import get_extraction_plan, ExtractionPlan
+from .geometry.line_slices import SplineCoefficients, KERNELS, _check_order
 from .geometry import path as paths
 from .utils.wcs_slicing import slice_wcs
+from .utils.readers import SpectralCubeReader, FITSReader, read_fits_cube
+
+# Default amount of memory used for each block of channels by iter_pv_slice
+ITER_MAX_MEMORY = 2 ** 27
 
 
 def extract_pv_slice(cube, path, wcs=None, spacing=1.0, order=3,
-                     respect_nan=True, assert_square=True):
+                     respect_nan=True, assert_square=True, engine='vectorized',
+                     coefficients=None, max_memory=None, chunk_channels=None,
+                     n_jobs=1, executor=None, lazy=False, dtype=None,
+                     spectral_range=None, spectral_bin=1, template_resolution=None,
+                     sparse=False):
     """
     Given a position-position-velocity cube with dimensions (nv, ny, nx), and
     a path, extract a position-velocity slice.
@@ -29,7 +39,9 @@ def extract_pv_slice(cube, path, wcs=None, spacing=1.0, order=3,
         The cube to extract a slice from. If this is a plain
         :class:`~numpy.ndarray` instance, the WCS information can optionally
         be specified with the ``wcs`` parameter. If a string, it should be
-        the name of a file containing a spectral cube.
+        the name of a file containing a spectral cube. FITS files and HDUs
+        with (x, y, spectral) axes are read directly, and only the part of
+        the cube covered by the path is read from the file.
     path : `Path` or list of 2-tuples
         The path along which to define the position-velocity slice. The path
         can contain coordinates defined in pixel or world coordinates.
@@ -41,9 +53,11 @@ def extract_pv_slice(cube, path, wcs=None, spacing=1.0, order=3,
         The position resolution in the final position-velocity slice. This
         can be given in pixel coordinates or as a
         :class:`~astropy.units.Quantity` instance with angle units.
-    order : int, optional
-        Spline interpolation order when using paths with zero width. Does not
-        have any effect for paths with a non-zero width.
+    order : int or {'keys', 'lanczos'}, optional
+        Spline interpolation order when using paths with zero width, or local
+        interpolation kernel which does not require prefiltering the cube
+        (see `~pvextractor.geometry.line_slices.extract_line_slice`). Does
+        not have any effect for paths with a non-zero width.
     respect_nan : bool, optional
         If set to `False`, NaN values are changed to zero before computing
         the slices. If set to `True`, in the case of line paths a second
@@ -54,6 +68,58 @@ def extract_pv_slice(cube, path, wcs=None, spacing=1.0, order=3,
         If the pixels are not square, the interpretation of the X-axis in
         the extracted PV diagram is ambiguous.  In some cases, it may be
         necessary to disable this check, though.
+    engine : {'vectorized', 'matplotlib'}, optional
+        The engine used to compute the overlap between the polygons of paths
+        with a non-zero width and the pixels. Does not have any effect for
+        paths with zero width.
+    coefficients : `~pvextractor.geometry.line_slices.SplineCoefficients`, optional
+        Precomputed spline coefficients of the cube for the same ``order``.
+        When extracting many slices from the same cube with ``order > 1``
+        (for example interactively), this avoids prefiltering the cube for
+        every slice. Does not have any effect for paths with a non-zero width.
+    max_memory : int or :class:`~astropy.units.Quantity`, optional
+        If specified, the spectral axis is processed in blocks of channels
+        such that the memory used for each block is approximately below this
+        value (in bytes, or as a quantity with units of information such as
+        ``u.GB``).
+    chunk_channels : int, optional
+        If specified, the number of channels to process at a time. This takes
+        precedence over ``max_memory``.
+    n_jobs : int, optional
+        The number of tasks to run in parallel (``-1`` to use all CPUs). The
+        result is identical to the serial extraction.
+    executor : {'thread', 'process'} or `~concurrent.futures.Executor`, optional
+        The executor used when ``n_jobs > 1``. By default, a thread pool is
+        used.
+    lazy : bool, optional
+        If `True`, the data of the returned HDU is a dask array, which is
+        only computed when it is accessed or written out. ``cube`` can then
+        also be a dask array.
+    dtype : `~numpy.dtype`, optional
+        The floating-point data type of the slice. Defaults to the data type
+        of the cube if it is floating-point, and to 64-bit floats otherwise
+        (see `~pvextractor.geometry.extract_slice` for the accuracy).
+    spectral_range : tuple, optional
+        The ``(start, stop)`` range of the spectral axis to extract, either as
+        channel indices (with the same meaning as for a `slice`), or as
+        :class:`~astropy.units.Quantity` instances with spectral units, in
+        which case the channels with centers in the range are used. Only
+        these channels are read from the cube.
+    spectral_bin : int, optional
+        The number of consecutive channels to average in each channel of the
+        slice. If the number of channels is not a multiple of
+        ``spectral_bin``, the last channels are dropped. NaN values are
+        ignored when averaging.
+    template_resolution : float, optional
+        If specified, the fraction of a pixel to which the positions of the
+        polygons of paths with a non-zero width are rounded when reusing the
+        overlaps of polygons along straight parts of the path (see
+        `~pvextractor.geometry.extract_slice`).
+    sparse : bool, optional
+        For paths with zero width and ``order`` 0 or 1 or a local
+        interpolation kernel, apply the interpolation as a sparse matrix
+        product rather than interpolating each channel (see
+        `~pvextractor.geometry.extract_slice`).
 
     Returns
     -------
@@ -61,7 +127,347 @@ def extract_pv_slice(cube, path, wcs=None, spacing=1.0, order=3,
         The position-velocity slice, as a FITS HDU object
     """
 
+    cube, wcs = _load_cube(cube, wcs=wcs)
+
+    pixel_spacing, world_spacing = _get_spacing(wcs, spacing, assert_square=assert_square)
+
+    spectral_range = get_spectral_channels(spectral_range, cube.shape[0], wcs=wcs,
+                                           spectral_bin=spectral_bin)
+
+    # Allow path to be passed in as list of 2-tuples
+    if not isinstance(path, paths.Path):
+        path = paths.Path(path)
+
+    # Files opened by _load_cube are closed once the slice is computed, except
+    # for lazy extraction, where the reader closes the file once released.
+    try:
+        pv_slice = extract_slice(cube, path, wcs=wcs, spacing=pixel_spacing,
+                                 order=order, respect_nan=respect_nan,
+                                 engine=engine, coefficients=coefficients,
+                                 max_memory=max_memory, chunk_channels=chunk_channels,
+                                 n_jobs=n_jobs, executor=executor, lazy=lazy,
+                                 dtype=dtype, spectral_range=spectral_range,
+                                 spectral_bin=spectral_bin,
+                                 template_resolution=template_resolution, sparse=sparse)
+    finally:
+        if not lazy:
+            _close_cube(cube)
+
+    # TODO: write path to BinTableHDU
+
+    header = _make_header(wcs, world_spacing, spectral_start=spectral_range[0],
+                          spectral_bin=spectral_bin)
+
+    return PrimaryHDU(data=pv_slice, header=header)
+
+
+def iter_pv_slice(cube, path, block=None, wcs=None, spacing=1.0, order=3,
+                  respect_nan=True, assert_square=True, engine='vectorized',
+                  coefficients=None, max_memory=None, n_jobs=1, executor=None,
+                  dtype=None, spectral_range=None, spectral_bin=1,
+                  template_resolution=None, sparse=False):
+    """
+    Extract a position-velocity slice one block of channels at a time.
+
+    The blocks are yielded as soon as they are computed, so that they can
+    be written out, plotted or analyzed before the whole slice is finished.
+    Only the footprint of the path in one block of channels of the cube and
+    the slice for that block are held in memory at a time, which makes it
+    possible to extract slices from cubes with many channels.
+
+    The parameters not listed below are the same as for `extract_pv_slice`.
+
+    Parameters
+    ----------
+    block : int, optional
+        The number of channels of the cube to process at a time. If
+        ``spectral_bin`` is larger than one, this is rounded to a multiple of
+        ``spectral_bin``. By default, the blocks are chosen such that they
+        use approximately ``max_memory`` bytes.
+    max_memory : int or :class:`~astropy.units.Quantity`, optional
+        The approximate amount of memory to use for each block if ``block``
+        is not given. Defaults to ``ITER_MAX_MEMORY`` (128 MB).
+
+    Yields
+    ------
+    channels : slice
+        The range of channels of the block in the slice, that is in the
+        spectral axis of the HDU returned by `extract_pv_slice` with the same
+        parameters.
+    data : `~numpy.ndarray`
+        The (z, n) slice for these channels
+    """
+
+    cube, wcs = _load_cube(cube, wcs=wcs)
+
+    pixel_spacing, _ = _get_spacing(wcs, spacing, assert_square=assert_square)
+
+    spectral_range = get_spectral_channels(spectral_range, cube.shape[0], wcs=wcs,
+                                           spectral_bin=spectral_bin)
+
+    if not isinstance(path, paths.Path):
+        path = paths.Path(path)
+
+    if block is None and max_memory is None:
+        max_memory = ITER_MAX_MEMORY
+
+    try:
+        plan = get_extraction_plan(path, pixel_spacing, cube.shape, wcs=wcs, engine=engine,
+                                   template_resolution=template_resolution)
+        blocks = plan.iter_extract(cube, order=order, respect_nan=respect_nan,
+                                   coefficients=coefficients, max_memory=max_memory,
+                                   chunk_channels=block, n_jobs=n_jobs, executor=executor,
+                                   dtype=dtype, spectral_range=spectral_range,
+                                   spectral_bin=spectral_bin, sparse=sparse)
+    except BaseException:
+        _close_cube(cube)
+        raise
+
+    return _closing(blocks, cube)
+
+
+def extract_pv_slices(cube, paths_list, wcs=None, spacing=1.0, order=3,
+                      respect_nan=True, assert_square=True, engine='vectorized',
+                      coefficients=None, max_memory=None, chunk_channels=None,
+                      n_jobs=1, executor=None, dtype=None, spectral_range=None,
+                      spectral_bin=1, template_resolution=None, sparse=False,
+                      generator=False):
+    """
+    Extract position-velocity slices along many paths from the same cube.
+
+    This gives the same results as calling `extract_pv_slice` for each path,
+    but the cube is only loaded once, the WCS and output header are only
+    computed once, and when many paths with zero width cover a large part of
+    the image, the spline coefficients of the cube (and of its NaN mask) are
+    computed once and shared between all the paths. The coefficients are
+    stored in the data type of the cube and take at least as much memory as
+    the cube, so they are not computed if ``max_memory`` or
+    ``chunk_channels`` is given.
+
+    The parameters not listed below are the same as for `extract_pv_slice`,
+    and apply to all paths.
+
+    Parameters
+    ----------
+    cube : :class:`~numpy.ndarray` or :class:`~spectral_cube.SpectralCube` or str or HDU
+        The cube to extract the slices from (see `extract_pv_slice`).
+    paths_list : iterable of `Path` or of lists of 2-tuples
+        The paths along which to define the position-velocity slices.
+    generator : bool, optional
+        If `True`, return a generator that extracts the slices one at a time
+        instead of a list.
+
+    Returns
+    -------
+    slices : list or generator of `PrimaryHDU`
+        The position-velocity slices, as FITS HDU objects
+    """
+
+    cube, wcs = _load_cube(cube, wcs=wcs)
+
+    pixel_spacing, world_spacing = _get_spacing(wcs, spacing, assert_square=assert_square)
+
+    spectral_range = get_spectral_channels(spectral_range, cube.shape[0], wcs=wcs,
+                                           spectral_bin=spectral_bin)
+
+    header = _make_header(wcs, world_spacing, spectral_start=spectral_range[0],
+                          spectral_bin=spectral_bin)
+
+    paths_list = [path if isinstance(path, paths.Path) else paths.Path(path)
+                  for path in paths_list]
+
+    plans = [get_extraction_plan(path, pixel_spacing, cube.shape, wcs=wcs, engine=engine,
+                                 template_resolution=template_resolution)
+             for path in paths_list]
+
+    if any(plan.is_line for plan in plans):
+        _check_order(order)
+
+    # If the paths with zero width together cover more than the image, it is
+    # cheaper to prefilter the whole cube once than the footprint of each path.
+    # This needs about as much memory as the cube, so is not done if the
+    # memory used for the extraction is limited.
+    if (coefficients is None and max_memory is None and chunk_channels is None
+            and order not in KERNELS and order > 1):
+        area = 0
+        for plan in plans:
+            if plan.is_line:
+                ymin, ymax, xmin, xmax = plan.footprint(order=order)
+                area += (ymax - ymin) * (xmax - xmin)
+        if area > cube.shape[1] * cube.shape[2]:
+            coefficients = SplineCoefficients(cube, order=order)
+
+    def _extract_all():
+        for plan in plans:
+            pv_slice = extract_slice(cube, plan, order=order, respect_nan=respect_nan,
+                                     coefficients=coefficients, max_memory=max_memory,
+                                     chunk_channels=chunk_channels, n_jobs=n_jobs,
+                                     executor=executor, dtype=dtype,
+                                     spectral_range=spectral_range,
+                                     spectral_bin=spectral_bin, sparse=sparse)
+            yield PrimaryHDU(data=pv_slice, header=header.copy())
+
+    slices = _closing(_extract_all(), cube)
+
+    if generator:
+        return slices
+    else:
+        return list(slices)
+
+
+class IncrementalExtractor(object):
+    """
+    Extract position-velocity slices from a cube along a path that is
+    extended one point at a time.
+
+    The columns of the last slice are kept together with the positions of
+    the samples (or the polygons) they were computed from. The samples along
+    a path only depend on the part of the path before them, so when points
+    are appended to the path (with `Path.add_point`) with the same width,
+    only the columns past the previous end of the path, starting with the
+    one straddling it, are extracted. Any other change to the path is also
+    handled, by reusing the columns up to the first sample that changed.
+
+    The parameters are the same as for `extract_pv_slice`, except for the
+    path, which is given to `extract`. The data of the cube should not be
+    modified while the extractor is in use. If the cube is given as a file
+    name, the file is kept open until `close` is called (the extractor can
+    also be used as a context manager).
+
+    Notes
+    -----
+    For paths with a non-zero width, the slice is identical to extracting
+    the whole slice again with `extract_pv_slice`. For paths with zero
+    width, the new columns are interpolated in the footprint of the new
+    part of the path only, so the slice differs from a full extraction by
+    rounding errors (see `~pvextractor.geometry.extract_slice`).
+    """
+
+    def __init__(self, cube, wcs=None, spacing=1.0, order=3, respect_nan=True,
+                 assert_square=True, engine='vectorized', coefficients=None,
+                 max_memory=None, chunk_channels=None, n_jobs=1, executor=None,
+                 dtype=None, spectral_range=None, spectral_bin=1,
+                 template_resolution=None, sparse=False):
+
+        self.cube, self.wcs = _load_cube(cube, wcs=wcs)
+
+        self.spacing, world_spacing = _get_spacing(self.wcs, spacing,
+                                                   assert_square=assert_square)
+
+        spectral_range = get_spectral_channels(spectral_range, self.cube.shape[0],
+                                               wcs=self.wcs, spectral_bin=spectral_bin)
+
+        self.header = _make_header(self.wcs, world_spacing,
+                                   spectral_start=spectral_range[0],
+                                   spectral_bin=spectral_bin)
+
+        self.engine = engine
+        self.template_resolution = template_resolution
+
+        self._options = dict(order=order, respect_nan=respect_nan,
+                             coefficients=coefficients, max_memory=max_memory,
+                             chunk_channels=chunk_channels, n_jobs=n_jobs,
+                             executor=executor, dtype=dtype,
+                             spectral_range=spectral_range, spectral_bin=spectral_bin,
+                             sparse=sparse)
+
+        self.clear()
+
+    def close(self):
+        """
+        Close the file of the cube, if it was opened by the extractor.
+        """
+        _close_cube(self.cube)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def clear(self):
+        """
+        Discard the columns kept from the previous slice.
+        """
+        self._samples = None
+        self._slice = None
+        self.n_computed = 0
+
+    def extract(self, path):
+        """
+        Extract the slice along ``path``, reusing the columns of the previous
+        slice where the samples did not change.
+
+        The number of columns that were extracted is stored in the
+        ``n_computed`` attribute.
+
+        Parameters
+        ----------
+        path : `Path` or list of 2-tuples
+            The path along which to define the position-velocity slice.
+
+        Returns
+        -------
+        slice : `PrimaryHDU`
+            The position-velocity slice, as a FITS HDU object
+        """
+
+        if not isinstance(path, paths.Path):
+            path = paths.Path(path)
+
+        # The geometry of each column, as one row of (x, y) positions for
+        # line paths, and of the polygon vertices for other paths.
+        if path.width is None:
+            polygons = None
+            x, y = path.sample_points(self.spacing, wcs=self.wcs)
+            samples = np.transpose([x, y])
+        else:
+            polygons = path.sample_polygons(self.spacing, wcs=self.wcs)
+            samples = np.hstack([np.array([p.x for p in polygons], dtype=float),
+                                 np.array([p.y for p in polygons], dtype=float)])
+
+        n_same = 0
+        if self._samples is not None and self._samples.shape[1] == samples.shape[1]:
+            n = min(len(samples), len(self._samples))
+            changed = np.any(samples[:n] != self._samples[:n], axis=1)
+            n_same = int(np.argmax(changed)) if np.any(changed) else n
+
+        if n_same < len(samples):
+            if polygons is None:
+                geometry = dict(x=samples[n_same:, 0], y=samples[n_same:, 1])
+            else:
+                geometry = dict(polygons=polygons[n_same:])
+            plan = ExtractionPlan.from_samples(self.cube.shape, self.spacing,
+                                               engine=self.engine,
+                                               template_resolution=self.template_resolution,
+                                               **geometry)
+            columns = plan.extract(self.cube, **self._options)
+            if n_same > 0:
+                columns = np.hstack([self._slice[:, :n_same], columns])
+        else:
+            columns = self._slice[:, :n_same]
+
+        self._samples = samples
+        self._slice = columns
+        self.n_computed = len(samples) - n_same
+
+        return PrimaryHDU(data=columns.copy(), header=self.header.copy())
+
+
+def _load_cube(cube, wcs=None):
+    """
+    Return the data and the sanitized WCS (if any) for the given cube.
+
+    If ``cube`` is a file name, the file is opened and should be closed with
+    `_close_cube` after use.
+    """
+
     if isinstance(cube, (str, ImageHDU, PrimaryHDU)):
+        # Cubes with standard axes are read directly from the FITS file, one
+        # block of the footprint of the path at a time.
+        reader, reader_wcs = read_fits_cube(cube)
+        if reader is not None:
+            return reader, sanitize_wcs(reader_wcs)
         try:
             from spectral_cube import SpectralCube
             cube = SpectralCube.read(cube)
@@ -73,13 +479,43 @@ def extract_pv_slice(cube, path, wcs=None, spacing=1.0, order=3,
     if _is_spectral_cube(cube):
         wcs = cube.wcs
         # The fits HEADER will preserve the UNIT, but pvextractor does not care
-        # what the flux units are
-        cube = cube.filled_data[...].value
+        # what the flux units are. We do not fill the whole cube here, since
+        # only the footprint of the path is read during the extraction.
+        cube = SpectralCubeReader(cube)
 
     if wcs is not None:
         wcs = sanitize_wcs(wcs)
 
-    if not isinstance(cube, np.ndarray) or wcs is not None:
+    return cube, wcs
+
+
+def _close_cube(cube):
+    """
+    Close the file opened by `_load_cube` for ``cube``, if any.
+    """
+    if isinstance(cube, FITSReader):
+        cube.close()
+
+
+def _closing(items, cube):
+    """
+    Yield the items of the generator ``items``, and close the file opened for
+    ``cube`` once it is exhausted or discarded.
+    """
+    try:
+        for item in items:
+            yield item
+    finally:
+        _close_cube(cube)
+
+
+def _get_spacing(wcs, spacing, assert_square=True):
+    """
+    Return the spacing in pixels and in world coordinates (or `None` if no
+    WCS is given).
+    """
+
+    if wcs is not None:
         try:
             scale = get_spatial_scale(wcs, assert_square=assert_square)
         except AssertionError as ex:
@@ -99,22 +535,18 @@ def extract_pv_slice(cube, path, wcs=None, spacing=1.0, order=3,
             pixel_spacing = spacing
             world_spacing = None
 
-    # Allow path to be passed in as list of 2-tuples
-    if not isinstance(path, paths.Path):
-        path = paths.Path(path)
+    return pixel_spacing, world_spacing
 
-    pv_slice = extract_slice(cube, path, wcs=wcs, spacing=pixel_spacing,
-                             order=order, respect_nan=respect_nan)
 
-    # Generate output header
+def _make_header(wcs, world_spacing, spectral_start=0, spectral_bin=1):
+    """
+    Generate the header of the position-velocity slice.
+    """
     if wcs is None:
-        header = Header()
+        return Header()
     else:
-        header = slice_wcs(wcs, spatial_scale=world_spacing).to_header()
-
-    # TODO: write path to BinTableHDU
-
-    return PrimaryHDU(data=pv_slice, header=header)
+        return slice_wcs(wcs, spatial_scale=world_spacing, spectral_start=spectral_start,
+                         spectral_bin=spectral_bin).to_header()
 
 
 def _is_spectral_cube(obj):
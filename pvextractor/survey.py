@@ -0,0 +1,334 @@
+"""
+Extraction of the same set of paths from many cubes, using a pool of worker
+processes on a single machine.
+"""
+
+import os
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .pvextractor import extract_pv_slices, _load_cube, _close_cube
+from .geometry import path as paths
+
+__all__ = ['extract_survey', 'SurveyResult']
+
+# Maximum amount of data copied at a time when loading a cube into shared
+# memory, so that cubes read from disk are not loaded twice.
+LOAD_BLOCK_SIZE = 2 ** 28
+
+
+class SurveyResult(object):
+    """
+    The slices extracted from one cube of a survey.
+
+    Attributes
+    ----------
+    cube : object
+        The cube, as given to `extract_survey`.
+    slices : list of `~astropy.io.fits.PrimaryHDU`
+        The slice for each path, or `None` for the paths whose extraction
+        failed.
+    errors : dict
+        The traceback of the last failure for each path that failed, keyed
+        by the index of the path. If the cube itself could not be loaded,
+        the traceback is stored with the key `None`.
+    attempts : int
+        The total number of tasks run for this cube, including retries.
+    nbytes : int
+        The size of the cube in bytes.
+    load_time : float
+        The time taken to load the cube into shared memory, in seconds.
+    extract_time : float
+        The time between submitting the first extraction task for the cube
+        and the completion of the last one, in seconds.
+    """
+
+    def __init__(self, cube, n_paths):
+        self.cube = cube
+        self.slices = [None] * n_paths
+        self.errors = {}
+        self.attempts = 0
+        self.nbytes = 0
+        self.load_time = 0.
+        self.extract_time = 0.
+
+    @property
+    def ok(self):
+        """
+        Whether all the slices were extracted.
+        """
+        return len(self.errors) == 0
+
+    @property
+    def throughput(self):
+        """
+        The number of slices extracted per second, including the time taken
+        to load the cube.
+        """
+        total = self.load_time + self.extract_time
+        n_slices = sum(hdu is not None for hdu in self.slices)
+        return n_slices / total if total > 0 else 0.
+
+    def summary(self):
+        """
+        A one-line summary of the extraction.
+        """
+        name = self.cube if isinstance(self.cube, str) else type(self.cube).__name__
+        if None in self.errors:
+            return "{0}: failed to load cube".format(name)
+        n_slices = sum(hdu is not None for hdu in self.slices)
+        return ("{0}: {1}/{2} slices, {3:.0f} MB loaded in {4:.2f}s, extracted in "
+                "{5:.2f}s ({6:.1f} slices/s, {7} tasks)"
+                .format(name, n_slices, len(self.slices), self.nbytes / 1e6,
+                        self.load_time, self.extract_time, self.throughput,
+                        self.attempts))
+
+    def __repr__(self):
+        return "<SurveyResult {0}>".format(self.summary())
+
+
+class _SharedCube(object):
+    """
+    A cube loaded into a block of shared memory, and the extraction tasks
+    running on it.
+    """
+
+    def __init__(self, result, data, wcs):
+
+        self.result = result
+        self.wcs = wcs
+        self.shape = tuple(data.shape)
+        self.dtype = np.dtype(data.dtype).newbyteorder('=')
+
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.memory = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+
+        try:
+            array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+            # Copy the cube one block of channels at a time
+            step = max(LOAD_BLOCK_SIZE // max(nbytes // max(self.shape[0], 1), 1), 1)
+            for k in range(0, self.shape[0], step):
+                array[k:k + step] = np.asarray(data[k:k + step])
+            del array
+        except BaseException:
+            self.release()
+            raise
+
+        result.nbytes = nbytes
+
+        self.pending = 0
+        self.start = None
+
+    def release(self):
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+
+def _extract_shared(name, shape, dtype, wcs, paths_list, kwargs):
+    """
+    Extract slices from a cube in shared memory, in a worker process.
+    """
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        cube = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+        slices = extract_pv_slices(cube, paths_list, wcs=wcs, **kwargs)
+        del cube
+    finally:
+        memory.close()
+    return slices
+
+
+def extract_survey(cubes, paths_list, n_jobs=-1, paths_per_task=None, retries=1,
+                   max_cubes=2, report=None, **kwargs):
+    """
+    Extract position-velocity slices along the same paths from many cubes,
+    using a pool of worker processes.
+
+    The cubes are loaded one at a time in the main process into shared
+    memory, and the paths are split into tasks that are distributed over
+    the worker processes, so that the data of the cubes is never copied to
+    the workers. While the slices of one cube are being extracted, the next
+    cubes are loaded. Tasks that fail (including because of a worker process
+    crashing) are retried, and failures are recorded without interrupting
+    the rest of the survey. Since a worker process dying stops the whole
+    pool of workers, all the tasks running at that time count as failed
+    and are retried in a new pool.
+
+    Parameters
+    ----------
+    cubes : iterable
+        The cubes to extract the slices from, as file names, HDUs or arrays
+        (see `~pvextractor.extract_pv_slice`). If arrays are given, their
+        WCS can be passed with the ``wcs`` keyword argument.
+    paths_list : iterable of `~pvextractor.Path` or of lists of 2-tuples
+        The paths along which to extract the slices.
+    n_jobs : int, optional
+        The number of worker processes (``-1`` to use all CPUs).
+    paths_per_task : int, optional
+        The number of paths extracted by each task. By default, the paths
+        are split evenly between the workers.
+    retries : int, optional
+        The number of times a failed task is retried.
+    max_cubes : int, optional
+        The maximum number of cubes held in shared memory at a time.
+    report : callable, optional
+        If given, this is called with the `SurveyResult` of each cube when
+        it completes (for example to print ``result.summary()``).
+    **kwargs
+        Other arguments are passed to `~pvextractor.extract_pv_slices` (for
+        example ``spacing``, ``order`` or ``spectral_range``).
+
+    Returns
+    -------
+    results : generator of `SurveyResult`
+        The slices and timing information for each cube, in the order of
+        ``cubes``. Each result is yielded as soon as all the slices of the
+        cube (and of the cubes before it) have been extracted.
+    """
+
+    paths_list = [path if isinstance(path, paths.Path) else paths.Path(path)
+                  for path in paths_list]
+
+    if n_jobs is None or n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(int(n_jobs), 1)
+
+    if paths_per_task is None:
+        paths_per_task = int(np.ceil(len(paths_list) / n_jobs))
+    paths_per_task = max(int(paths_per_task), 1)
+
+    groups = [list(range(i, min(i + paths_per_task, len(paths_list))))
+              for i in range(0, len(paths_list), paths_per_task)]
+
+    wcs = kwargs.pop('wcs', None)
+    for name in ('n_jobs', 'executor', 'generator'):
+        kwargs.pop(name, None)
+
+    return _run_survey(iter(cubes), paths_list, groups, n_jobs, retries, max_cubes,
+                       report, wcs, kwargs)
+
+
+def _run_survey(cubes, paths_list, groups, n_jobs, retries, max_cubes, report, wcs, kwargs):
+
+    pool = ProcessPoolExecutor(max_workers=n_jobs)
+
+    # Cubes currently in shared memory (or that failed to load), in order,
+    # and the extraction tasks in flight as future: (cube, group, attempt)
+    active = deque()
+    futures = {}
+
+    def submit(shared, group, attempt):
+        future = pool.submit(_extract_shared, shared.memory.name, shared.shape,
+                             shared.dtype, shared.wcs, [paths_list[i] for i in group],
+                             kwargs)
+        futures[future] = (shared, group, attempt)
+        shared.pending += 1
+        shared.result.attempts += 1
+
+    def finish(shared):
+        if shared.memory is not None:
+            shared.result.extract_time = time.time() - shared.start
+            shared.release()
+
+    def load(cube):
+        result = SurveyResult(cube, len(paths_list))
+        time1 = time.time()
+        try:
+            data, cube_wcs = _load_cube(cube, wcs=wcs)
+            try:
+                shared = _SharedCube(result, data, cube_wcs)
+            finally:
+                _close_cube(data)
+        except Exception:
+            result.errors[None] = traceback.format_exc()
+            return result
+        result.load_time = time.time() - time1
+        shared.start = time.time()
+        for group in groups:
+            submit(shared, group, 0)
+        return shared
+
+    try:
+
+        exhausted = False
+
+        while True:
+
+            while not exhausted and len(active) < max_cubes:
+                try:
+                    cube = next(cubes)
+                except StopIteration:
+                    exhausted = True
+                else:
+                    active.append(load(cube))
+
+            if not active:
+                break
+
+            head = active[0]
+            if isinstance(head, SurveyResult) or head.pending == 0:
+                active.popleft()
+                if isinstance(head, SurveyResult):
+                    result = head
+                else:
+                    finish(head)
+                    result = head.result
+                if report is not None:
+                    report(result)
+                yield result
+                continue
+
+            done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+
+            failed = []
+            broken = False
+
+            for future in done:
+                shared, group, attempt = futures.pop(future)
+                shared.pending -= 1
+                try:
+                    slices = future.result()
+                except Exception as exc:
+                    broken |= isinstance(exc, BrokenProcessPool)
+                    failed.append((shared, group, attempt, traceback.format_exc()))
+                else:
+                    for i, hdu in zip(group, slices):
+                        shared.result.slices[i] = hdu
+                        shared.result.errors.pop(i, None)
+
+            if broken:
+                # A worker process died, which breaks the whole pool, so the
+                # tasks still in flight are failed as well and resubmitted to
+                # a new pool.
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = ProcessPoolExecutor(max_workers=n_jobs)
+                error = "Worker process died while this task was running"
+                for future, (shared, group, attempt) in list(futures.items()):
+                    shared.pending -= 1
+                    failed.append((shared, group, attempt, error))
+                futures.clear()
+
+            for shared, group, attempt, error in failed:
+                for i in group:
+                    shared.result.errors[i] = error
+                if attempt < retries:
+                    submit(shared, group, attempt + 1)
+
+            # Free the memory of cubes as soon as they are done
+            for shared in active:
+                if isinstance(shared, _SharedCube) and shared.pending == 0:
+                    finish(shared)
+
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        for shared in active:
+            if isinstance(shared, _SharedCube):
+                shared.release()
@@ -74,3 +74,56 @@ def test_gui_from_fits_filename(tmp_path):
     pv.show(block=False)
 
     pv.close()
+
+
+def test_gui_precompute(monkeypatch):
+
+    pytest.importorskip('PyQt6')
+
+    hdu = make_test_hdu()
+
+    pv = PVSlicer(hdu, clim=(-0.02, 2), backend='QtAgg', precompute=False)
+    assert pv.coefficients is None
+    pv.close()
+
+    # Cubes larger than the limit do not precompute the coefficients by default
+    monkeypatch.setattr('pvextractor.gui.PRECOMPUTE_MAX_MEMORY', hdu.data.nbytes - 1)
+    pv = PVSlicer(hdu, clim=(-0.02, 2), backend='QtAgg')
+    assert pv.coefficients is None
+    pv.close()
+
+    monkeypatch.setattr('pvextractor.gui.PRECOMPUTE_MAX_MEMORY', hdu.data.nbytes)
+    pv = PVSlicer(hdu, clim=(-0.02, 2), backend='QtAgg')
+    assert pv.coefficients is not None
+    assert pv.coefficients.dtype == hdu.data.dtype
+    pv.close()
+
+
+def test_gui_slice_from_coefficients():
+
+    pytest.importorskip('PyQt6')
+
+    hdu = make_test_hdu()
+
+    pv = PVSlicer(hdu, clim=(-0.02, 2), backend='QtAgg', precompute=True)
+    pv.coefficients.wait()
+
+    calls = []
+    interpolate = pv.coefficients.interpolate
+
+    def spy(k, x, y, **kwargs):
+        calls.append(k)
+        return interpolate(k, x, y, **kwargs)
+
+    pv.coefficients.interpolate = spy
+
+    # Boxes without a width are sampled from the precomputed coefficients
+    pv.box.x = [0.0, 1.0]
+    pv.box.y = [0.0, 1.0]
+    pv.box.width = 0.
+    pv.update_pv_slice(pv.box)
+
+    assert len(calls) > 0
+    assert np.all(np.isfinite(pv.pv_slice.data))
+
+    pv.close()
@@ -30,6 +30,15 @@ class TestPixel(object):
         path.add_point((75., 60.))
         assert_allclose(path.get_xy(), [(0., 0.), (50., 50.), (75., 60.)])
 
+    def test_add_point_sampling(self):
+        path = Path(self.pixel)
+        x, y = path.sample_points(spacing=10.)
+        assert len(x) == 7
+        path.add_point((50., 100.))
+        x, y = path.sample_points(spacing=10.)
+        assert len(x) == 12
+        assert_allclose(x[-1], 50.)
+
     def test_add_point_invalid(self):
         path = Path(self.pixel)
         with pytest.raises(TypeError) as exc:
@@ -84,6 +93,37 @@ class TestCoord(object):
                          (131.29272, 143.51288),
                          (203.29272, 167.51288)])
 
+    def test_geometry_cache(self, monkeypatch):
+
+        path = Path(self.gal, width=30 * u.arcsec)
+
+        wcs = WCS(HEADER)
+
+        expected = path.sample_polygons(spacing=5., wcs=wcs)
+
+        # The transformation to pixel coordinates is only done once per WCS
+        calls = []
+        world2pix = path._world2pix
+        monkeypatch.setattr(path, '_world2pix', lambda wcs: calls.append(wcs) or world2pix(wcs))
+
+        polygons = path.sample_polygons(spacing=5., wcs=wcs)
+        path.sample_points(spacing=5., wcs=WCS(HEADER))
+        path.get_xy(wcs=wcs)
+        assert calls == []
+        for poly, poly_ref in zip(polygons, expected):
+            assert_allclose(poly.x, poly_ref.x)
+            assert_allclose(poly.y, poly_ref.y)
+
+        wcs.wcs.crpix[0] += 10.
+        assert_allclose(path.get_xy(wcs=wcs)[0], (117.29272, 71.51288))
+        assert len(calls) == 1
+
+        # Changing the width is taken into account
+        path.width = 60 * u.arcsec
+        polygons = path.sample_polygons(spacing=5., wcs=wcs)
+        assert_allclose(polygons[0].x[0] - polygons[0].x[3],
+                        2 * (expected[0].x[0] - expected[0].x[3]))
+
     def test_pixel_diff_frame(self):
 
         # Specify coordinates in a different frame from the WCS
@@ -1,12 +1,21 @@
+import gc
+import sys
+import warnings
+
 import numpy as np
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_equal
 
 from astropy.io import fits
 import pytest
 from astropy.wcs import WCS
 
-from ..pvextractor import extract_pv_slice
+from ..pvextractor import (extract_pv_slice, extract_pv_slices, iter_pv_slice,
+                           IncrementalExtractor)
 from ..geometry.path import Path
+from ..geometry.line_slices import SplineCoefficients
+from ..geometry.plan import ExtractionPlan
+from ..geometry import extract_slice
+from ..utils.readers import read_fits_cube
 
 # Use a similar header as in the spectral_cube package
 HEADER_STR = """
@@ -123,6 +132,15 @@ class TestExtraction:
         assert_allclose(slice_hdu.data[0], np.array([np.nan, 0.9648, 0.4, -0.0368, 0.5622,
                                                      1.6478, 1.9278, np.nan, np.nan, np.nan]))
 
+    def test_pv_slice_hdu_line_path_order_3_coefficients(self, data):
+        array = data.data if isinstance(data, fits.PrimaryHDU) else data
+        coefficients = SplineCoefficients(array, order=3)
+        path = Path([(1., -0.5), (1., 3.5)])
+        slice_hdu = extract_pv_slice(data, path, spacing=0.4, order=3,
+                                     coefficients=coefficients)
+        assert_allclose(slice_hdu.data[0], np.array([np.nan, 0.9648, 0.4, -0.0368, 0.5622,
+                                                     1.6478, 1.9278, np.nan, np.nan, np.nan]))
+
     def test_pv_slice_hdu_poly_path(self, data):
         path = Path([(1., -0.5), (1., 3.5)], width=0.001)
         slice_hdu = extract_pv_slice(data, path, spacing=0.4)
@@ -169,3 +187,331 @@ def test_output_wcs(make_data):
             np.testing.assert_almost_equal(slice_hdu.header[key], reference[key])
         except TypeError:
             assert slice_hdu.header[key] == reference[key]
+
+
+@pytest.mark.parametrize('make_data', (make_test_hdu, make_test_spectralcube))
+def test_extract_pv_slices(make_data):
+
+    data = make_data()
+
+    paths = [Path([(1., -0.5), (1., 3.5)]),
+             [(0., 0.), (2., 3.)],
+             Path([(1., -0.5), (1., 3.5)], width=0.001)]
+
+    for generator in (False, True):
+
+        slices = extract_pv_slices(data, paths, spacing=0.4, order=3,
+                                   generator=generator)
+
+        for path, slice_hdu in zip(paths, slices):
+            expected = extract_pv_slice(data, path, spacing=0.4, order=3)
+            assert_allclose(slice_hdu.data, expected.data)
+            assert slice_hdu.header == expected.header
+
+
+def test_extract_pv_slices_shared_coefficients(monkeypatch):
+
+    np.random.seed(12345)
+
+    array = np.random.random((3, 20, 20))
+    array[1, 5, 5] = np.nan
+
+    # Enough paths that their footprints cover more than the image
+    paths = [Path([(2., float(i)), (17., float(i) + 1.5)]) for i in range(10)]
+
+    slices = extract_pv_slices(array, paths, order=3)
+
+    for path, slice_hdu in zip(paths, slices):
+        expected = extract_pv_slice(array, path, order=3)
+        assert_allclose(slice_hdu.data, expected.data, atol=1e-12)
+
+    # Coefficients are stored in the data type of the cube, and blocks of
+    # channels are interpolated from them in parallel.
+    coefficients = SplineCoefficients(array.astype(np.float32), order=3)
+    assert coefficients.dtype == np.float32
+    slices = extract_pv_slices(array.astype(np.float32), paths, order=3,
+                               coefficients=coefficients, n_jobs=2, dtype=np.float64)
+    for path, slice_hdu in zip(paths, slices):
+        expected = extract_pv_slice(array.astype(np.float32), path, order=3, dtype=np.float64)
+        assert_allclose(slice_hdu.data, expected.data, rtol=1e-6, atol=1e-6)
+
+    # The coefficients of the whole cube are not computed if the memory used
+    # is limited
+    def no_coefficients(*args, **kwargs):
+        raise AssertionError("coefficients should not be computed")
+
+    monkeypatch.setattr('pvextractor.pvextractor.SplineCoefficients', no_coefficients)
+    slices = extract_pv_slices(array, paths, order=3, chunk_channels=1)
+    assert_allclose(slices[0].data, extract_pv_slice(array, paths[0], order=3).data)
+
+
+@pytest.mark.parametrize('dask', (False, True))
+def test_spectral_cube_footprint_only(dask):
+
+    from spectral_cube import SpectralCube, DaskSpectralCube
+    from ..utils.readers import SpectralCubeReader
+
+    hdu = make_test_hdu()
+    hdu.data = np.random.random((5, 40, 30))
+
+    if dask:
+        cube = DaskSpectralCube.read(hdu)
+    else:
+        cube = SpectralCube.read(hdu)
+
+    views = []
+
+    class RecordingReader(SpectralCubeReader):
+        def __getitem__(self, view):
+            views.append(view)
+            return super().__getitem__(view)
+
+    path = Path([(3., 4.), (6., 9.)])
+
+    slice_hdu = extract_pv_slice(cube, path, order=1)
+
+    expected = extract_pv_slice(cube.filled_data[...].value, path, wcs=cube.wcs, order=1)
+    assert_allclose(slice_hdu.data, expected.data)
+
+    # Check that only the footprint of the path is read
+    extract_slice(RecordingReader(cube), path, order=1)
+    assert len(views) == 1
+    ymin, ymax, xmin, xmax = ExtractionPlan(path, 1.0, cube.shape).footprint(order=1)
+    assert views[0] == (slice(0, 5), slice(ymin, ymax), slice(xmin, xmax))
+    assert (ymax - ymin) * (xmax - xmin) < 40 * 30 / 4
+
+
+@pytest.mark.parametrize('width', (None, 1.5))
+def test_fits_file_scaled(tmp_path, width):
+
+    # Integer cube with BSCALE/BZERO/BLANK, read directly from the file
+    values = np.random.randint(-1000, 1000, (5, 40, 30)).astype(np.int16)
+    values[2, 10:20, 5:15] = -32768
+
+    hdu = make_test_hdu()
+    hdu.data = values
+    hdu.header['BSCALE'] = 0.5
+    hdu.header['BZERO'] = 3.
+    hdu.header['BLANK'] = -32768
+    filename = str(tmp_path / 'scaled.fits')
+    hdu.writeto(filename)
+
+    expected_data = fits.getdata(filename)
+    assert np.isnan(expected_data[2, 15, 10])
+
+    path = Path([(3., 4.), (26., 30.)], width=width)
+
+    with fits.open(filename) as hdulist:
+        slice_hdu = extract_pv_slice(hdulist[0], path, order=1)
+        # The full cube was never loaded
+        assert not hdulist[0]._data_loaded
+
+    expected = extract_pv_slice(expected_data, path, wcs=WCS(hdu.header), order=1)
+
+    assert_allclose(slice_hdu.data, expected.data)
+    assert slice_hdu.header == expected.header
+
+    assert_allclose(extract_pv_slice(filename, path, order=1).data, expected.data)
+
+    # Sections of the file only contain the columns that are needed
+    with read_fits_cube(filename)[0] as reader:
+        assert_allclose(reader[1:3, 4:20, 5:9], expected_data[1:3, 4:20, 5:9])
+        assert reader.hdulist is not None
+    assert reader.hdulist is None
+
+
+def test_fits_file_non_standard_axes(tmp_path):
+
+    # Cubes with non-standard axes are still read with spectral-cube
+    hdu = make_test_hdu()
+    header = WCS(hdu.header).swapaxes(0, 2).to_header()
+    filename = str(tmp_path / 'swapped.fits')
+    fits.PrimaryHDU(data=hdu.data.transpose(), header=header).writeto(filename)
+
+    reader, wcs = read_fits_cube(filename)
+    assert reader is None
+
+    path = Path([(1., -0.5), (1., 3.5)])
+    slice_hdu = extract_pv_slice(filename, path, spacing=0.4, order=0)
+    assert_allclose(slice_hdu.data[0], np.array([1., 1., 0., 0., 0., 2., 2., 2., np.nan, np.nan]))
+
+
+def test_fits_file_not_cube(tmp_path, monkeypatch):
+
+    # Readers that fail to open an HDU should not raise on garbage collection
+    unraisable = []
+    monkeypatch.setattr(sys, 'unraisablehook', unraisable.append)
+
+    filename = str(tmp_path / 'hypercube.fits')
+    fits.PrimaryHDU(data=np.zeros((2, 3, 4, 5))).writeto(filename)
+
+    reader, wcs = read_fits_cube(filename)
+    assert reader is None
+    gc.collect()
+
+    assert unraisable == []
+
+
+def test_lazy(tmp_path):
+
+    da = pytest.importorskip('dask.array')
+
+    hdu = make_test_hdu()
+    path = Path([(1., -0.5), (1., 3.5)])
+
+    expected = extract_pv_slice(hdu, path, spacing=0.4)
+
+    slice_hdu = extract_pv_slice(da.from_array(hdu.data, chunks=(2, 4, 3)), path,
+                                 wcs=WCS(hdu.header), spacing=0.4, lazy=True)
+    assert isinstance(slice_hdu.data, da.Array)
+    assert slice_hdu.header == expected.header
+
+    slice_hdu.writeto(tmp_path / 'slice.fits')
+    assert_allclose(fits.getdata(tmp_path / 'slice.fits'), expected.data)
+
+
+def test_dtype():
+
+    hdu = make_test_hdu()
+    path = Path([(1., -0.5), (1., 3.5)])
+
+    slice_hdu = extract_pv_slice(hdu.data.astype(np.float32), path, spacing=0.4)
+    assert slice_hdu.data.dtype == np.float32
+    assert slice_hdu.header['BITPIX'] == -32
+
+    slice_hdu = extract_pv_slice(hdu.data.astype(np.float32), path, spacing=0.4,
+                                 dtype=np.float64)
+    assert slice_hdu.header['BITPIX'] == -64
+
+
+@pytest.mark.parametrize('lazy', (False, True))
+def test_spectral_range_bin(lazy):
+
+    if lazy:
+        pytest.importorskip('dask')
+
+    from astropy import units as u
+
+    hdu = make_test_hdu()
+    hdu.data = np.random.random((9, 4, 3))
+    path = Path([(1., -0.5), (1., 3.5)])
+
+    full = extract_pv_slice(hdu, path, spacing=0.4)
+
+    # Channels 1 to 7, binned by 3 (the last channel is dropped)
+    spectral_range = (-321214.698632 * u.m / u.s + 1288.21496879 * u.m / u.s * 0.6,
+                      (-321214.698632 + 1288.21496879 * 7.2) * u.m / u.s)
+    slice_hdu = extract_pv_slice(hdu, path, spacing=0.4, spectral_range=spectral_range,
+                                 spectral_bin=3, lazy=lazy)
+    assert slice_hdu.data.shape == (2, 10)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = np.nanmean(full.data[1:7].reshape(2, 3, -1), axis=1)
+    assert_allclose(np.asarray(slice_hdu.data), expected)
+
+    # The spectral axis of the header is consistent with the binned channels
+    velocities = WCS(full.header).sub([2]).wcs_pix2world(np.arange(9), 0)[0]
+    binned = WCS(slice_hdu.header).sub([2]).wcs_pix2world(np.arange(2), 0)[0]
+    assert_allclose(binned, velocities[1:7].reshape(2, 3).mean(axis=1))
+
+    slice_hdu = extract_pv_slice(hdu.data, path, spacing=0.4, spectral_range=(1, 7),
+                                 spectral_bin=3)
+    assert_allclose(slice_hdu.data, expected)
+
+
+@pytest.mark.parametrize('width', (None, 1.))
+def test_iter_pv_slice(width):
+
+    from astropy import units as u
+
+    np.random.seed(12345)
+
+    hdu = make_test_hdu()
+    hdu.data = np.random.random((9, 4, 3))
+    hdu.data[2, 1, 1] = np.nan
+    path = Path([(1., -0.5), (1., 3.5)], width=width)
+
+    expected = extract_pv_slice(hdu, path, spacing=0.4).data
+
+    blocks = list(iter_pv_slice(hdu, path, block=2, spacing=0.4))
+    assert [channels for channels, data in blocks] == [slice(0, 2), slice(2, 4), slice(4, 6),
+                                                       slice(6, 8), slice(8, 9)]
+    for channels, data in blocks:
+        assert_allclose(data, expected[channels])
+
+    # Channels are given in the binned slice
+    expected = extract_pv_slice(hdu, path, spacing=0.4, spectral_range=(1, 8),
+                                spectral_bin=3).data
+    blocks = list(iter_pv_slice(hdu, path, block=4, spacing=0.4, spectral_range=(1, 8),
+                                spectral_bin=3))
+    assert [channels for channels, data in blocks] == [slice(0, 1), slice(1, 2)]
+    for channels, data in blocks:
+        assert_allclose(data, expected[channels])
+
+    # By default, the blocks are limited by the memory used
+    blocks = list(iter_pv_slice(hdu, path, spacing=0.4, max_memory=100 * u.byte))
+    assert len(blocks) == 9
+
+
+@pytest.mark.parametrize(('width', 'order'), ((None, 0), (None, 3), (1., 3)))
+def test_incremental_extractor(width, order):
+
+    np.random.seed(12345)
+
+    hdu = make_test_hdu()
+    hdu.data = np.random.random((5, 30, 30))
+    hdu.data[2, 10, 12] = np.nan
+
+    extractor = IncrementalExtractor(hdu, spacing=0.7, order=order)
+
+    path = Path([(2., 3.), (12., 4.)], width=width)
+    slice_hdu = extractor.extract(path)
+    assert extractor.n_computed == 14
+    assert_allclose(slice_hdu.data, extract_pv_slice(hdu, path, spacing=0.7, order=order).data)
+
+    # Only the columns after the previous end of the path are extracted
+    for point, n_computed in (((20., 15.), 19), ((7., 25.), 24)):
+        path.add_point(point)
+        slice_hdu = extractor.extract(path)
+        expected = extract_pv_slice(hdu, path, spacing=0.7, order=order)
+        assert extractor.n_computed == n_computed
+        assert slice_hdu.data.shape[1] == expected.data.shape[1]
+        assert_allclose(slice_hdu.data, expected.data, rtol=1e-10)
+        assert slice_hdu.header == expected.header
+
+    if width is not None:
+        assert_equal(slice_hdu.data, expected.data)
+
+    # Paths that are changed elsewhere or made shorter are also supported
+    path = Path([(2., 3.), (12., 4.), (15., 3.)], width=width)
+    slice_hdu = extractor.extract(path)
+    assert extractor.n_computed == (4 if width is None else 3)
+    assert_allclose(slice_hdu.data, extract_pv_slice(hdu, path, spacing=0.7, order=order).data,
+                    rtol=1e-10)
+
+    path = Path([(2., 3.), (10., 3.)], width=width)
+    slice_hdu = extractor.extract(path)
+    assert extractor.n_computed == 11
+    assert_allclose(slice_hdu.data, extract_pv_slice(hdu, path, spacing=0.7, order=order).data,
+                    rtol=1e-10)
+
+
+def test_invalid_order():
+
+    hdu = make_test_hdu()
+
+    with pytest.raises(TypeError) as exc:
+        extract_pv_slice(hdu, Path([(1., -0.5), (1., 3.5)]), order=2.5)
+    assert exc.value.args[0] == "order should be a positive integer"
+
+    # The order is not used for paths with a non-zero width
+    extract_pv_slice(hdu, Path([(1., -0.5), (1., 3.5)], width=1.), order=2.5)
+
+    # Unknown kernels are reported before any extraction
+    with pytest.raises(ValueError) as exc:
+        extract_pv_slice(hdu, Path([(1., -0.5), (1., 3.5)]), order='cubic')
+    assert exc.value.args[0] == "order should be an integer or one of keys, lanczos"
+
+    with pytest.raises(ValueError) as exc:
+        extract_pv_slices(hdu, [Path([(1., -0.5), (1., 3.5)])], order='cubic')
+    assert exc.value.args[0] == "order should be an integer or one of keys, lanczos"
@@ -0,0 +1,96 @@
+import os
+
+from numpy.testing import assert_allclose
+
+from ..pvextractor import extract_pv_slice
+from ..geometry.path import Path
+from ..survey import extract_survey
+from .test_slicer import make_test_hdu
+
+
+class FailingPath(Path):
+    """
+    A path that cannot be extracted.
+    """
+
+    def sample_points(self, *args, **kwargs):
+        raise ValueError("Path cannot be sampled")
+
+
+class CrashingPath(Path):
+    """
+    A path that kills the worker process extracting it the first time.
+    """
+
+    def __init__(self, xy, flag):
+        super(CrashingPath, self).__init__(xy)
+        self.flag = flag
+
+    def sample_points(self, *args, **kwargs):
+        if not os.path.exists(self.flag):
+            open(self.flag, 'w').close()
+            os._exit(1)
+        return super(CrashingPath, self).sample_points(*args, **kwargs)
+
+
+def make_survey(tmp_path, n_cubes=3):
+    filenames = []
+    for i in range(n_cubes):
+        hdu = make_test_hdu()
+        hdu.data = hdu.data * (i + 1)
+        filenames.append(str(tmp_path / 'cube{0}.fits'.format(i)))
+        hdu.writeto(filenames[-1])
+    return filenames
+
+
+def test_survey(tmp_path):
+
+    filenames = make_survey(tmp_path)
+    filenames.insert(1, str(tmp_path / 'missing.fits'))
+
+    paths = [Path([(0., 0.), (2., 3.)]), Path([(0., 0.), (2., 3.)], width=1.),
+             [(2., 0.), (0., 3.)], FailingPath([(0., 0.), (1., 1.)])]
+
+    reported = []
+    results = list(extract_survey(filenames, paths, n_jobs=2, paths_per_task=1,
+                                  spacing=0.5, report=reported.append))
+
+    assert reported == results
+    assert [result.cube for result in results] == filenames
+
+    # A cube that cannot be read does not interrupt the survey
+    assert list(results[1].errors) == [None]
+    assert results[1].summary().endswith('failed to load cube')
+
+    for filename, result in zip(filenames[:1] + filenames[2:], results[:1] + results[2:]):
+
+        for path, hdu in zip(paths[:3], result.slices[:3]):
+            expected = extract_pv_slice(filename, path, spacing=0.5)
+            assert_allclose(hdu.data, expected.data)
+            assert hdu.header == expected.header
+
+        # The failing path is retried once, without affecting the other paths
+        assert not result.ok
+        assert list(result.errors) == [3]
+        assert 'Path cannot be sampled' in result.errors[3]
+        assert result.slices[3] is None
+        assert result.attempts == 5
+        assert result.nbytes == 5 * 4 * 3 * 8
+        assert result.throughput > 0
+
+
+def test_survey_worker_crash(tmp_path):
+
+    filenames = make_survey(tmp_path, n_cubes=2)
+
+    # The worker extracting the first path dies, so the tasks in flight are
+    # retried in a new pool of workers.
+    paths = [CrashingPath([(0., 0.), (2., 3.)], str(tmp_path / 'crashed')),
+             Path([(2., 0.), (0., 3.)])]
+
+    results = list(extract_survey(filenames, paths, n_jobs=2, paths_per_task=1))
+
+    for filename, result in zip(filenames, results):
+        assert result.ok
+        for path, hdu in zip(paths, result.slices):
+            assert_allclose(hdu.data, extract_pv_slice(filename, Path(path._xy)).data)
@@ -0,0 +1,295 @@
+"""
+Array-like wrappers around data cubes, which only read the parts of the cube
+that are needed to extract a slice.
+"""
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+
+class SpectralCubeReader(object):
+    """
+    Array-like access to the filled data of a
+    :class:`~spectral_cube.SpectralCube`.
+
+    Indexing this object only computes (and for cubes backed by dask or
+    memory-mapped arrays, only reads) the requested view of the cube, with
+    masked values set to NaN.
+
+    Parameters
+    ----------
+    cube : :class:`~spectral_cube.SpectralCube`
+        The spectral cube to read from
+    """
+
+    def __init__(self, cube):
+        self.cube = cube
+        self.shape = tuple(cube.shape)
+        self.ndim = len(self.shape)
+
+    @property
+    def dtype(self):
+        return self[:0, :0, :0].dtype
+
+    def __getitem__(self, view):
+        return np.asarray(self.cube.filled_data[view].value)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+
+def chunk_shape(cube):
+    """
+    Return the shape of the chunks that an array-like object (for example an
+    h5py dataset or a zarr array) is stored in, or `None` if the object is not
+    chunked or if its chunks do not have a regular shape.
+
+    For sharded zarr arrays, the shape of the shards is returned, since these
+    are the units that are read from the storage.
+    """
+    chunks = getattr(cube, 'shards', None) or getattr(cube, 'chunks', None)
+    if chunks is None or len(chunks) != len(cube.shape):
+        return None
+    try:
+        return tuple(int(n) for n in chunks)
+    except TypeError:
+        return None
+
+
+def _normalize_view(view, ndim):
+    """
+    Expand a view into a tuple with one index per dimension.
+    """
+    if not isinstance(view, tuple):
+        view = (view,)
+    for i, index in enumerate(view):
+        if index is Ellipsis:
+            view = view[:i] + (slice(None),) * (ndim - len(view) + 1) + view[i + 1:]
+            break
+    return view + (slice(None),) * (ndim - len(view))
+
+
+class FITSReader(object):
+    """
+    Array-like access to the data of a FITS HDU containing a spectral cube.
+
+    If the HDU is backed by a file and its data has not been loaded yet,
+    indexing this object only reads the requested part of the cube from the
+    file (memory-mapping the file if possible), and BSCALE, BZERO and BLANK
+    are only applied to the values that are read.
+
+    The reader can be used as a context manager, which closes ``hdulist``
+    (if given) on exit.
+
+    Parameters
+    ----------
+    hdu : `~astropy.io.fits.PrimaryHDU` or `~astropy.io.fits.ImageHDU`
+        The HDU containing the cube, which should have three dimensions, or
+        four dimensions with a leading axis (in NumPy order) of size one.
+    hdulist : `~astropy.io.fits.HDUList`, optional
+        The file the HDU was read from, if it is owned by the reader and
+        should be closed by `close`.
+    """
+
+    def __init__(self, hdu, hdulist=None):
+        # Set before validating the HDU, since __del__ runs even if this
+        # raises (the caller then still owns hdulist).
+        self.hdulist = None
+        shape = tuple(hdu.shape)
+        if len(shape) == 4 and shape[0] == 1:
+            self._leading = (0,)
+        elif len(shape) == 3:
+            self._leading = ()
+        else:
+            raise ValueError("HDU should contain a three-dimensional cube")
+        self.hdu = hdu
+        self.hdulist = hdulist
+        self.shape = shape[-3:]
+        self.ndim = 3
+
+    def close(self):
+        """
+        Close the file owned by the reader, if any.
+        """
+        if self.hdulist is not None:
+            self.hdulist.close()
+            self.hdulist = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        # Lazy extractions keep a reference to the reader, so the file can
+        # only be closed once the reader is no longer used.
+        self.close()
+
+    @property
+    def dtype(self):
+        # Empty sections of FITS files are always returned as 64-bit floats,
+        # so a single pixel is read instead.
+        return self[:1, :1, :1].dtype
+
+    def __getitem__(self, view):
+
+        view = _normalize_view(view, self.ndim)
+
+        if self.hdu.fileinfo() is not None and not self.hdu._data_loaded:
+            # Sections only read the requested channels, rows and columns
+            data = self.hdu.section[self._leading + view]
+        else:
+            data = self.hdu.data[self._leading + view]
+
+        data = np.asarray(data)
+        return data.astype(data.dtype.newbyteorder('='), copy=False)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+
+def read_fits_cube(cube):
+    """
+    Open a spectral cube in a FITS file or HDU without reading its data.
+
+    Parameters
+    ----------
+    cube : str or `~astropy.io.fits.PrimaryHDU` or `~astropy.io.fits.ImageHDU`
+        The name of the FITS file, or the HDU containing the cube.
+
+    Returns
+    -------
+    reader : `FITSReader` or `None`
+        The reader for the cube, which owns the file if a file name was
+        given and should then be closed after use, or `None` if the cube does not have three
+        dimensions or if its axes are not ordered as (x, y, spectral), in
+        which case it should be read with :class:`~spectral_cube.SpectralCube`.
+    wcs : `~astropy.wcs.WCS` or `None`
+        The three-dimensional WCS of the cube.
+    """
+
+    if isinstance(cube, str):
+        # By default the file is memory-mapped if possible, but unlike with
+        # memmap=True, scaled data can still be read (one section at a time).
+        hdulist = fits.open(cube)
+        for hdu in hdulist:
+            if hdu.is_image and hdu.header.get('NAXIS', 0) > 0:
+                break
+        else:
+            hdulist.close()
+            return None, None
+    else:
+        hdulist = None
+        hdu = cube
+
+    try:
+        reader = FITSReader(hdu, hdulist=hdulist)
+    except ValueError:
+        if hdulist is not None:
+            hdulist.close()
+        return None, None
+
+    wcs = WCS(hdu.header)
+    if wcs.naxis == 4:
+        wcs = wcs.dropaxis(3)
+
+    axis_types = [axis['coordinate_type'] for axis in wcs.get_axis_types()]
+    if wcs.naxis != 3 or axis_types != ['celestial', 'celestial', 'spectral']:
+        reader.close()
+        return None, None
+
+    return reader, wcs
+
+
+class TransposedCube(object):
+    """
+    A working copy of a (nz, ny, nx) cube stored with the spectral axis last,
+    so that the spectrum of each pixel is contiguous in memory.
+
+    This object can be used in place of the cube when extracting slices.
+    Paths with a non-zero width (and nearest-neighbor interpolation along
+    paths with zero width) gather whole spectra from the pixels they
+    overlap, which is several times faster with this layout than with the
+    usual one, where consecutive values of a spectrum are ``ny * nx``
+    elements apart. Spline interpolation is carried out one channel at a
+    time, so it uses the original cube.
+
+    Creating the copy costs about as much as reading the whole cube once,
+    so this is only worthwhile when extracting many slices from the same
+    cube, for example in interactive sessions or batch runs.
+
+    Parameters
+    ----------
+    cube : `~numpy.ndarray` or array-like
+        The (nz, ny, nx) cube. A reference to it is kept for interpolation.
+    filename : str, optional
+        If given, the copy is stored in a memory-mapped ``.npy`` file rather
+        than in memory, and can be reopened with `TransposedCube.open`.
+    max_memory : int, optional
+        The approximate amount of memory (in bytes) used to copy each block
+        of rows of the cube.
+    """
+
+    def __init__(self, cube, filename=None, max_memory=2 ** 28):
+
+        self.cube = cube
+
+        nz, ny, nx = cube.shape
+        # Empty sections of FITS files are always 64-bit floats, so the data
+        # type of the cube is used where available.
+        dtype = getattr(cube, 'dtype', None)
+        if dtype is None:
+            dtype = np.asarray(cube[:1, :1, :1]).dtype
+        dtype = np.dtype(dtype).newbyteorder('=')
+
+        if filename is None:
+            self.spectra = np.empty((ny, nx, nz), dtype=dtype)
+        else:
+            self.spectra = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                                     shape=(ny, nx, nz))
+
+        step = max(int(max_memory // max(nz * nx * dtype.itemsize, 1)), 1)
+        for ymin in range(0, ny, step):
+            ymax = min(ymin + step, ny)
+            self.spectra[ymin:ymax] = np.moveaxis(np.asarray(cube[:, ymin:ymax, :]), 0, -1)
+
+        if filename is not None:
+            self.spectra.flush()
+
+    @classmethod
+    def open(cls, filename, cube=None):
+        """
+        Open a copy previously written to ``filename``, optionally with a
+        reference to the original ``cube`` (otherwise the copy is also used
+        for interpolation).
+        """
+        self = cls.__new__(cls)
+        self.spectra = np.load(filename, mmap_mode='r')
+        self.cube = cube
+        return self
+
+    @property
+    def shape(self):
+        ny, nx, nz = self.spectra.shape
+        return (nz, ny, nx)
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def dtype(self):
+        return self.spectra.dtype
+
+    def __getitem__(self, view):
+        view = _normalize_view(view, self.ndim)
+        values = self.spectra[view[1], view[2], view[0]]
+        if isinstance(view[0], (int, np.integer)):
+            return values
+        return np.moveaxis(values, -1, 0)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(np.moveaxis(self.spectra, -1, 0), dtype=dtype)
@@ -5,7 +5,7 @@ from astropy.wcs import WCS, WCSSUB_SPECTRAL
 from .wcs_utils import get_spectral_scale
 
 
-def slice_wcs(wcs, spatial_scale):
+def slice_wcs(wcs, spatial_scale, spectral_start=0, spectral_bin=1):
     """
     Slice a WCS header for a spectral cube to a Position-Velocity WCS, with
     ctype "OFFSET" for the spatial offset direction
@@ -17,6 +17,11 @@ def slice_wcs(wcs, spatial_scale):
         have the spectral axis along the third dimension.
     spatial_scale: :class:`~astropy.units.Quantity`
         The spatial scale of the position axis
+    spectral_start : int, optional
+        The index of the first channel of the cube included in the slice
+    spectral_bin : int, optional
+        The number of channels of the cube averaged in each channel of the
+        slice
 
     Returns
     -------
@@ -40,4 +45,14 @@ def slice_wcs(wcs, spatial_scale):
     except AttributeError:
         pass
 
+    # Set spectral parameters. The first channel of the slice is centered on
+    # the average of channels spectral_start to spectral_start + spectral_bin - 1
+    if spectral_start != 0 or spectral_bin != 1:
+        wcs_slice.wcs.crpix[1] = ((wcs_slice.wcs.crpix[1] - 1 - spectral_start
+                                   - (spectral_bin - 1) / 2.) / spectral_bin + 1)
+        if wcs_slice.wcs.has_cd():
+            wcs_slice.wcs.cd[:, 1] *= spectral_bin
+        else:
+            wcs_slice.wcs.cdelt[1] *= spectral_bin
+
     return wcs_slice
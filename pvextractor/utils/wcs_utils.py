@@ -1,3 +1,5 @@
+import hashlib
+
 import numpy as np
 from astropy import units as u
 from astropy.wcs import WCSSUB_CELESTIAL, WCSSUB_SPECTRAL
@@ -68,3 +70,66 @@ def sanitize_wcs(mywcs):
     return mywcs
 
 
+def wcs_fingerprint(wcs):
+    """
+    Return a string that uniquely identifies a WCS transformation, or
+    ``'None'`` if no WCS is given.
+    """
+    if wcs is None:
+        return 'None'
+    header = wcs.to_header_string(relax=True)
+    return hashlib.sha1(header.encode('utf-8')).hexdigest()
+
+
+def get_spectral_channels(spectral_range, nz, wcs=None, spectral_bin=1):
+    """
+    Convert a spectral range to a range of channels.
+
+    Parameters
+    ----------
+    spectral_range : tuple or `None`
+        The ``(start, stop)`` range, either as channel indices (with the same
+        meaning as for a `slice`), or as quantities with spectral units. In
+        the latter case, the channels whose centers lie within the range are
+        selected. In both cases, either bound can be `None` to extend the
+        range to the first or last channel.
+    nz : int
+        The number of channels in the cube
+    wcs : :class:`~astropy.wcs.WCS`, optional
+        The WCS of the cube, needed if the range is given in spectral units
+    spectral_bin : int, optional
+        If larger than one, the range is shortened so that it contains a
+        whole number of bins of ``spectral_bin`` channels.
+
+    Returns
+    -------
+    kmin, kmax : int
+        The range of channels, such that the selected channels are
+        ``kmin`` to ``kmax - 1``.
+    """
+
+    if spectral_bin != int(spectral_bin) or spectral_bin < 1:
+        raise ValueError("spectral_bin should be a positive integer")
+
+    if spectral_range is None:
+        kmin, kmax = 0, nz
+    elif any(isinstance(value, u.Quantity) for value in spectral_range):
+        if wcs is None:
+            raise TypeError("No WCS has been specified, so spectral_range "
+                            "should be given in channels")
+        spectral_wcs = wcs.sub([WCSSUB_SPECTRAL])
+        unit = u.Unit(spectral_wcs.wcs.cunit[0])
+        # Missing bounds extend the range to the first or last channel
+        pixels = np.array([0., nz - 1.])
+        for i, value in enumerate(spectral_range):
+            if value is not None:
+                value = u.Quantity(value).to_value(unit, equivalencies=u.spectral())
+                pixels[i] = spectral_wcs.wcs_world2pix([[value]], 0)[0, 0]
+        kmin = max(int(np.ceil(pixels.min() - 1e-6)), 0)
+        kmax = min(int(np.floor(pixels.max() + 1e-6)) + 1, nz)
+    else:
+        kmin, kmax, _ = slice(*spectral_range).indices(nz)
+
+    kmax = max(kmin + (kmax - kmin) // int(spectral_bin) * int(spectral_bin), kmin)
+
+    return kmin, kmax